@@ -2,16 +2,36 @@
 app.py contains all of the server application
 this is where you'll find all of the get/post request handlers
 the socket event handlers are inside of socket_routes.py
+
+the app is built by create_app(), and preload() does the work of the first requests
+(database, ORM mappers, templates, friend graph) before the server starts taking connections
+startup is timed from the first line of this file to the end of preload(), the "ready" point,
+which is printed and served at /ready
 '''
 
-from flask import Flask, render_template, request, abort, url_for, jsonify, session
-from flask_session import Session
-from flask_socketio import SocketIO
+# the start of the startup timing
+import time
+STARTED_AT = time.perf_counter()
+
+# has to come first, it monkey patches the standard library when ASYNC_MODE is eventlet or gevent
+import blocking
+
+from flask import Blueprint, Flask, Response, current_app, render_template, request, abort, url_for, jsonify, session, stream_with_context, redirect
 import os
+import json
 import db
-import secrets
-import bcrypt
-from flask_bcrypt import Bcrypt
+import message_bus
+import workers
+import passwords
+import secret_keys
+import session_store
+import archive
+import retention
+import message_writer
+import outbound
+import backpressure
+import socket_routes
+from socket_routes import socketio
 
 # import logging
 
@@ -19,37 +39,150 @@ from flask_bcrypt import Bcrypt
 # log = logging.getLogger('werkzeug')
 # log.setLevel(logging.ERROR)
 
-app = Flask(__name__)
-bcrypt = Bcrypt(app)
-app.config['SECRET_KEY'] = os.urandom(24)  # Secure key
-
-# 配置会话管理
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = 'session_files'
-app.config['SESSION_PERMANENT'] = False
-app.config['SESSION_USE_SIGNER'] = True
-
-Session(app)
-
-# secret key used to sign the session cookie
-app.config['SECRET_KEY'] = secrets.token_hex()
-socketio = SocketIO(app)
-
-# don't remove this!!
-import socket_routes
+# where the server listens
+HOST = os.environ.get("HOST", "127.0.0.1")
+PORT = int(os.environ.get("PORT", 5000))
+# number of worker processes, more than one needs a message queue between them
+WORKERS = int(os.environ.get("WORKERS", 1))
+# most connections a single worker serves at once in eventlet/gevent mode
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 10000))
+# socket.io emits to rooms are fanned out to every worker through this queue,
+# sqlite:/// uses the built-in bus in message_bus.py, redis:// kafka:// zmq+tcp:// amqp:// use
+# the python-socketio managers for those brokers
+MESSAGE_QUEUE = os.environ.get("MESSAGE_QUEUE") or ("sqlite:///database/bus.db" if WORKERS > 1 else None)
+
+# all the get/post request handlers below are registered on this blueprint
+bp = Blueprint("main", __name__)
+
+# moves old messages out of the messages table into archive segments, see archive.py
+# it runs on an engine of its own, its statements run in native threads under eventlet/gevent
+archiver = archive.Archiver(db.get_background_engine)
+# deletes expired messages, accepted friend requests and sessions in small batches, see retention.py
+# it waits whenever the message writer has messages queued
+retention_sweeper = retention.RetentionSweeper(db.get_background_engine, busy=message_writer.writer.queue_depth)
+
+# keeps the friend graph of every worker in sync, a change made in one worker
+# is applied to the other workers' copies through the message bus
+db.friend_graph.subscribe(
+    lambda action, username, friend_username: message_bus.publish_invalidation(
+        "friend_graph", action=action, username=username, friend_username=friend_username
+    )
+)
+
+def apply_friend_graph_change(action, username, friend_username):
+    if action == "add":
+        db.friend_graph.add_friendship(username, friend_username, notify=False)
+    else:
+        db.friend_graph.remove_friendship(username, friend_username, notify=False)
+    socket_routes.friendship_changed(action, username, friend_username)
+
+message_bus.on_invalidate("friend_graph", apply_friend_graph_change)
+# changes announced before this worker's listener started never reach it,
+# so the graph is reloaded from the database once the listener is running
+message_bus.on_resync(db.friend_graph.invalidate)
+
+# the friend snapshots of open sockets are updated on every friendship change, see connections.py
+db.friend_graph.subscribe(socket_routes.friendship_changed)
+
+def create_app() -> Flask:
+    app = Flask(__name__)
+    # secret keys used to sign the session cookie
+    # they are kept on disk (see secret_keys.py) so a restart doesn't log everyone out,
+    # cookies are signed with the newest key and checked against all of them
+    app.config['SECRET_KEY'] = secret_keys.KeyRing().load().keys()
+
+    # 配置会话管理
+    # sessions are stored in the sessions table with a per-worker cache in front, see session_store.py
+    app.config['SESSION_PERMANENT'] = False
+    app.config['SESSION_USE_SIGNER'] = True
+
+    app.session_interface = session_store.SQLiteSessionInterface(
+        app,
+        permanent=app.config['SESSION_PERMANENT'],
+        use_signer=app.config['SESSION_USE_SIGNER'],
+        # expired sessions are deleted by the retention sweeper
+        sweep_interval=0,
+    )
+
+    # picks the bcrypt work factor for this machine once and keeps it on disk (see passwords.py),
+    # unless BCRYPT_ROUNDS pins it
+    # runs before any worker is forked, so every worker uses the same value
+    if not os.environ.get("BCRYPT_ROUNDS"):
+        passwords.hasher.calibrate()
+
+    # the socket event handlers in socket_routes.py are attached to the app here
+    if MESSAGE_QUEUE:
+        socketio.init_app(app, async_mode=blocking.ASYNC_MODE, client_manager=message_bus.make_manager(MESSAGE_QUEUE))
+    else:
+        socketio.init_app(app, async_mode=blocking.ASYNC_MODE)
+    # chat events for the same connection are sent in batches and held back for slow readers, see outbound.py
+    outbound.coalescer.install(socketio.server)
+
+    # with several workers a long-polling session can't follow a client from one process
+    # to another, so clients are told to use websockets only
+    app.config['SOCKETIO_TRANSPORTS'] = ["websocket"] if WORKERS > 1 else ["polling", "websocket"]
+
+    # threads don't survive a fork, so each worker starts archiving on its first request
+    app.before_request(archiver.start)
+    app.before_request(retention_sweeper.start)
+
+    app.config['READY'] = False
+    app.register_blueprint(bp)
+    return app
+
+# does the work of the first requests before the server starts, so no user waits for it
+# called before any worker is forked, the workers inherit everything loaded here
+# the end of preload is the "ready" point of the startup timing
+def preload(app: Flask):
+    created_at = time.perf_counter()
+    db.warm_up()
+    # compiles every template once, jinja keeps the compiled templates in its cache
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    ready_at = time.perf_counter()
+
+    app.config['STARTUP_TIMINGS'] = {
+        "create_app_ms": round((created_at - STARTED_AT) * 1000, 1),
+        "preload_ms": round((ready_at - created_at) * 1000, 1),
+        "ready_ms": round((ready_at - STARTED_AT) * 1000, 1),
+    }
+    app.config['READY'] = True
+    print(f" * Ready in {app.config['STARTUP_TIMINGS']['ready_ms']:.0f} ms")
+
+# readiness check, 503 until preload() has finished
+@bp.route("/ready")
+def ready():
+    if not current_app.config.get('READY'):
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True, **current_app.config['STARTUP_TIMINGS']})
+
+# counters of this worker process
+@bp.route("/stats")
+def stats():
+    return jsonify({
+        "pid": os.getpid(),
+        "message_writer": message_writer.writer.stats(),
+        "friend_graph": db.friend_graph.stats(),
+        "sessions": current_app.session_interface.stats(),
+        "connections": socket_routes.connections.stats(),
+        "outbound": outbound.coalescer.stats(),
+        "rate_limits": backpressure.limiter.stats(),
+        "archive": archiver.stats(),
+        "retention": retention_sweeper.stats(),
+    })
 
 # index page
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.jinja")
 
 # login page
-@app.route("/login")
+@bp.route("/login")
 def login():    
     return render_template("login.jinja")
 
 # handles a post request when the user clicks the log in button
-@app.route("/login/user", methods=["POST"])
+@bp.route("/login/user", methods=["POST"])
 def login_user():
     if not request.is_json:
         abort(404)
@@ -62,19 +195,30 @@ def login_user():
         return "Error: User does not exist!"
 
     # verify the password.
-    if not bcrypt.check_password_hash(user.password, password):
-        return "Error: Password does not match!"
+    # bcrypt runs in the password process pool, which turns requests away when it is full
+    try:
+        if not passwords.hasher.check(password, user.password):
+            return "Error: Password does not match!"
+    except passwords.PasswordPoolBusy:
+        return "Error: Server is busy, please try again!"
+
+    # the hash was made with a lower work factor, replace it while we have the password
+    if passwords.hasher.needs_rehash(user.password):
+        try:
+            db.update_password(username, passwords.hasher.hash(password))
+        except passwords.PasswordPoolBusy:
+            pass
 
     session['username'] = username
-    return url_for('home', username=username)
+    return url_for('main.home', username=username)
 
 # handles a get request to the signup page
-@app.route("/signup")
+@bp.route("/signup")
 def signup():
     return render_template("signup.jinja")
 
 # handles a post request when the user clicks the signup button
-@app.route("/signup/user", methods=["POST"])
+@bp.route("/signup/user", methods=["POST"])
 def signup_user():
     if not request.is_json:
         abort(404)
@@ -82,14 +226,19 @@ def signup_user():
     password = request.json.get("password")
 
     # Encrypt passwords using a hash function.
-    pw_hash = bcrypt.generate_password_hash(password).decode('utf-8')
-
-    if db.get_user(username) is None:
-        db.insert_user(username, pw_hash)
-        return url_for('home', username=username)
+    try:
+        pw_hash = passwords.hasher.hash(password)
+    except passwords.PasswordPoolBusy:
+        return "Error: Server is busy, please try again!"
+
+    # insert_user returns False when the username is taken
+    # a new user goes straight to the home page, so the session is logged in here as well
+    if db.insert_user(username, pw_hash):
+        session['username'] = username
+        return url_for('main.home', username=username)
     return "Error: User already exists!"
 
-@app.route('/add_friend', methods=['POST'])
+@bp.route('/add_friend', methods=['POST'])
 def add_friend():
     data = request.json
     if not data:
@@ -107,25 +256,32 @@ def add_friend():
         return jsonify({"success": False, "error": "User does not exist"})
 
     # Add friend to the database
-    success = db.add_friend_request(username, friend_username)
+    success, error = db.add_friend_request(username, friend_username)
     if success:
+        socket_routes.push_friend_update(friend_username, "request_received", username)
         return jsonify({"success": True})
     else:
-        return jsonify({"success": False, "error": "Failed to add friend"})
+        return jsonify({"success": False, "error": error or "Failed to add friend"})
 
 # handler when a "404" error happens
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(_):
     return render_template('404.jinja'), 404
 
 # home page, where the messaging app is
-@app.route("/home")
+# the friend requests, friends, articles and inbox are rendered into the page,
+# so loading it takes one request instead of one per list
+# the page is always the logged in user's, the username in the url is ignored
+@bp.route("/home")
 def home():
-    if request.args.get("username") is None:
-        abort(404)
-    return render_template("home.jinja", username=request.args.get("username"))
-
-@app.route("/home?username=<username>", methods=['GET'])
+    username = session.get("username")
+    if username is None:
+        return redirect(url_for('main.login'))
+    return render_template("home.jinja", username=username,
+                           bootstrap=db.get_home_bootstrap(username),
+                           socket_transports=current_app.config['SOCKETIO_TRANSPORTS'])
+
+@bp.route("/home?username=<username>", methods=['GET'])
 def get_friends():
     username = request.args.get('username')
     if not username:
@@ -135,7 +291,7 @@ def get_friends():
         friend_list = []
     return jsonify({"success": True, "friends": friend_list})
 
-@app.route('/pending_requests')
+@bp.route('/pending_requests')
 def pending_requests():
     username = request.args.get('username')
     if not username:
@@ -149,23 +305,28 @@ def pending_requests():
     else:
         return jsonify({"success": False, "error": "Failed to fetch pending friend requests"})
 
-@app.route('/accept_friend_request', methods=['POST'])
+@bp.route('/accept_friend_request', methods=['POST'])
 def accept_friend_request():
     data = request.json
     from_username = data.get('from_username')
     to_username = data.get('to_username')
-    db.accept_friend_request(from_username, to_username)
+    # both users are told about the change over their socket instead of reloading their lists
+    if db.accept_friend_request(from_username, to_username) is True:
+        socket_routes.push_friend_update(to_username, "request_removed", from_username)
+        socket_routes.push_friend_update(to_username, "friend_added", from_username)
+        socket_routes.push_friend_update(from_username, "friend_added", to_username)
     return jsonify(success=True)
 
-@app.route('/decline_friend_request', methods=['POST'])
+@bp.route('/decline_friend_request', methods=['POST'])
 def decline_friend_request():
     data = request.json
     from_username = data.get('from_username')
     to_username = data.get('to_username')
-    db.decline_friend_request(from_username, to_username)
+    if db.decline_friend_request(from_username, to_username) is True:
+        socket_routes.push_friend_update(to_username, "request_removed", from_username)
     return jsonify(success=True)
 
-@app.route('/confirmed_friends')
+@bp.route('/confirmed_friends')
 def confirmed_friends():
     username = request.args.get('username')
     if not username:
@@ -179,7 +340,7 @@ def confirmed_friends():
     else:
         return jsonify({"success": False, "error": "Failed to fetch confirmed friends"})
 
-@app.route('/remove_friend', methods=['POST'])
+@bp.route('/remove_friend', methods=['POST'])
 def remove_friend():
     data = request.json
     if not data:
@@ -192,33 +353,67 @@ def remove_friend():
         abort(400, description="Missing username or friend username")
 
     # Remove friend from the friend list in the database
-    success = db.remove_friend(username, friend_username)
+    success, error = db.remove_friend(username, friend_username)
     if success:
+        socket_routes.push_friend_update(username, "friend_removed", friend_username)
+        socket_routes.push_friend_update(friend_username, "friend_removed", username)
         return jsonify({"success": True})
     else:
-        return jsonify({"success": False, "error": "Failed to remove friend"})
+        return jsonify({"success": False, "error": error or "Failed to remove friend"})
 
-@app.route('/chat_request', methods=['POST'])
+@bp.route('/chat_request', methods=['POST'])
 def chat_request():
     # Get data from request
     data = request.json
     sender = data.get('sender')
     receiver = data.get('receiver')
-    # Check if the receiver exists in the database
-    user_exists = db.check_user_exists(receiver)
-    if not user_exists:
-        # If Receiver doesn't exist
-        return jsonify({"success": False, "error": "User does not exist"})
     # Check if the sender and receiver are already friends
+    # this comes from the in-memory friend graph, so the common case needs no database access
     are_friends = db.check_friends(sender, receiver)
     if are_friends:
         # If already friends, allow chat
         return jsonify({"success": True, "status": "friends"})
-    else:
-        return jsonify({"success": False, "error": "You are not friends with this user"})
+    # Check if the receiver exists in the database
+    user_exists = db.check_user_exists(receiver)
+    if not user_exists:
+        # If Receiver doesn't exist
+        return jsonify({"success": False, "error": "User does not exist"})
+    return jsonify({"success": False, "error": "You are not friends with this user"})
     
+# one page of the logged in user's conversations, the most recently active first, with the last message
+# and the number of unread messages of each. before is the next_before of the previous page
+@bp.route('/inbox')
+def inbox():
+    # the user comes from the login session, never from the query string
+    username = session.get("username")
+    if username is None:
+        abort(403)
+    before = request.args.get('before', None, type=int)
+    limit = request.args.get('limit', db.INBOX_PAGE_SIZE, type=int)
+    return jsonify({"success": True, **db.get_inbox(username, before=before, limit=limit)})
+
+# streams the logged in user's messages as newline delimited json, one message per line
+# since_id resumes after the last message the client has, limit caps the number of lines,
+# peer restricts it to the conversation with one user
+# rows go out as they are read from the database so a full export runs in constant memory
+@bp.route('/get_messages')
+def get_messages():
+    # the user comes from the login session, never from the query string
+    username = session.get("username")
+    if username is None:
+        abort(403)
+    peer = request.args.get('peer')
+    since_id = request.args.get('since_id', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+
+    def generate():
+        for message in db.iter_messages(username, peer=peer, since_id=since_id, limit=limit):
+            yield json.dumps(message) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 # 处理文章的获取和创建
-@app.route('/articles', methods=['GET', 'POST'])
+@bp.route('/articles', methods=['GET', 'POST'])
 def handle_articles():
     if request.method == 'GET':
         articles = db.get_all_articles()  # 获取所有文章的函数
@@ -229,7 +424,7 @@ def handle_articles():
         return jsonify(success=True)
 
 # 处理评论的获取和创建
-@app.route('/articles/<int:article_id>/comments', methods=['GET', 'POST'])
+@bp.route('/articles/<int:article_id>/comments', methods=['GET', 'POST'])
 def handle_comments(article_id):
     if request.method == 'GET':
         comments = db.get_comments(article_id)  # 获取评论的函数
@@ -240,4 +435,20 @@ def handle_comments(article_id):
         return jsonify(success=True)
 
 if __name__ == '__main__':
-    socketio.run(app, ssl_context=('./certs/localhost.crt', './certs/localhost.key'))
\ No newline at end of file
+    app = create_app()
+    preload(app)
+    ssl_context = ('./certs/localhost.crt', './certs/localhost.key')
+    # the database engine resets its connection pool in each forked worker by itself, see db.py
+    # the message bus listener is a thread, so every worker starts its own before serving
+    # a stopping worker writes out the messages it still has queued before it exits
+    if WORKERS > 1:
+        workers.serve(app, HOST, PORT, WORKERS, ssl_context=ssl_context,
+                      after_fork=lambda: message_bus.start(socketio.server),
+                      before_exit=message_writer.writer.stop,
+                      async_mode=socketio.async_mode, max_connections=MAX_CONNECTIONS)
+    else:
+        if socketio.async_mode != 'threading':
+            workers.raise_open_file_limit()
+        message_bus.start(socketio.server)
+        socketio.run(app, host=HOST, port=PORT,
+                     **workers.server_options(socketio.async_mode, ssl_context, MAX_CONNECTIONS))
\ No newline at end of file
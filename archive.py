@@ -0,0 +1,406 @@
+'''
+archive
+cold storage for old chat messages
+
+messages older than ARCHIVE_AFTER_DAYS are moved out of the messages table into compressed,
+append-only segment files in ARCHIVE_DIR, so the table and its indexes only hold recent
+history and stay small enough to live in the page cache
+
+a segment file is a run of zlib compressed blocks, each a json list of up to ARCHIVE_BLOCK_SIZE
+consecutive messages of one conversation. a segment is written once and never changed.
+the archive_blocks table (models.ArchiveBlock) is the block index: the segment, the position
+in the file and the id / seq range of every block, so reading old history is one indexed
+lookup plus one read per block, however big the archive gets
+
+a segment file is written and fsynced first, then its index rows are added and the archived
+rows deleted in one transaction. a crash in between leaves an unreferenced file and the
+messages still in the table, so nothing is lost or stored twice
+
+the newest message of a conversation is never archived, the conversation row points at it
+for the inbox. retention.py may delete it later on, the next seq then comes from the
+conversation row's last_seq (see db.insert_messages)
+
+the history reads in db.py merge both tiers, within a conversation every archived message
+is older than every message still in the table, so the archive simply continues where the table ends
+
+every worker archives in a background thread every ARCHIVE_INTERVAL seconds (0 turns it off),
+the queries, compression and fsync of a segment run in a native thread under eventlet/gevent,
+so archiving a backlog doesn't freeze the worker's connections. or run it by hand with
+    python3 archive.py run [days]
+'''
+
+import heapq
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import delete, func, insert, select, text
+
+import blocking
+from models import ArchiveBlock, Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "database/archive")
+# messages older than this are archived
+ARCHIVE_AFTER = timedelta(days=float(os.environ.get("ARCHIVE_AFTER_DAYS", 30)))
+# messages per block, the unit that is read and decompressed at once
+BLOCK_SIZE = int(os.environ.get("ARCHIVE_BLOCK_SIZE", 256))
+# messages per segment file, also how many rows one archiving transaction deletes
+SEGMENT_SIZE = int(os.environ.get("ARCHIVE_SEGMENT_SIZE", 10000))
+# seconds between archiving runs
+INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 3600))
+# decompressed blocks kept in memory by each worker
+BLOCK_CACHE_SIZE = int(os.environ.get("ARCHIVE_BLOCK_CACHE", 64))
+# pause between two segments of a run, so chat writes can get in between them
+PAUSE = 0.05
+
+MAGIC = b"MSGSEG1\n"
+# the message fields stored in a block, in order, the same keys db._message_row returns
+FIELDS = ("id", "sender", "receiver", "message", "timestamp", "seq", "client_key")
+
+class ArchiveConflict(Exception):
+    pass
+
+# writes one segment file, blocks are appended and the file only gets its real name once complete
+class SegmentWriter():
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.name = f"{time.time_ns()}-{os.getpid()}.seg"
+        self.tmp_path = self.directory / (self.name + ".tmp")
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+
+    # appends the rows (Message rows of one conversation in seq order) as one block
+    # and returns its index entry
+    def add_block(self, conversation_id: int, rows) -> dict:
+        data = zlib.compress(json.dumps([
+            [row.id, row.sender, row.receiver, row.message,
+             row.timestamp.isoformat() if row.timestamp else None, row.seq, row.client_key]
+            for row in rows
+        ], separators=(",", ":")).encode("utf-8"))
+        self.file.write(data)
+        entry = {
+            "segment": self.name,
+            "conversation_id": conversation_id,
+            "first_id": rows[0].id,
+            "last_id": rows[-1].id,
+            "first_seq": rows[0].seq,
+            "last_seq": rows[-1].seq,
+            "first_timestamp": rows[0].timestamp,
+            "last_timestamp": rows[-1].timestamp,
+            "count": len(rows),
+            "offset": self.offset,
+            "length": len(data),
+        }
+        self.offset += len(data)
+        return entry
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.directory / self.name)
+        # makes the rename itself durable
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def abort(self):
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+# least recently used cache of decompressed blocks, keyed by (segment, offset)
+# blocks never change, so an entry never goes stale
+class BlockCache():
+    def __init__(self, max_size: int = BLOCK_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            messages = self.entries.get(key)
+            if messages is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return messages
+
+    def put(self, key, messages):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = messages
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+block_cache = BlockCache()
+
+# the messages of one block in seq order, as dicts shaped like db._message_row
+def read_block(block, directory: str = ARCHIVE_DIR) -> list:
+    key = (block.segment, block.offset)
+    messages = block_cache.get(key)
+    if messages is None:
+        with open(Path(directory) / block.segment, "rb") as f:
+            f.seek(block.offset)
+            data = f.read(block.length)
+        messages = [dict(zip(FIELDS, values)) for values in json.loads(zlib.decompress(data))]
+        block_cache.put(key, messages)
+    return messages
+
+# up to limit archived messages of the conversation with an id below before_id (None for no bound), newest first
+# every block has at least one message, so limit blocks are always enough
+def read_before(conn, conversation_id: int, before_id: int = None, limit: int = 50) -> list:
+    query = select(ArchiveBlock).where(ArchiveBlock.conversation_id == conversation_id)
+    if before_id is not None:
+        query = query.where(ArchiveBlock.first_id < before_id)
+    query = query.order_by(ArchiveBlock.first_id.desc()).limit(limit)
+    messages = []
+    for block in conn.execute(query):
+        for message in reversed(read_block(block)):
+            if before_id is None or message["id"] < before_id:
+                messages.append(message)
+                if len(messages) == limit:
+                    return messages
+    return messages
+
+# up to limit archived messages of the conversation with a seq above since_seq, oldest first
+def read_since(conn, conversation_id: int, since_seq: int, limit: int) -> list:
+    query = select(ArchiveBlock) \
+        .where(ArchiveBlock.conversation_id == conversation_id, ArchiveBlock.last_seq > since_seq) \
+        .order_by(ArchiveBlock.last_seq.asc()) \
+        .limit(limit)
+    messages = []
+    for block in conn.execute(query):
+        for message in read_block(block):
+            if message["seq"] > since_seq:
+                messages.append(message)
+                if len(messages) == limit:
+                    return messages
+    return messages
+
+# the archived messages of the given conversations with an id above since_id, in id order
+# conversation_ids is a list or a select of ids. only the block index is read up front,
+# each conversation's blocks are read one at a time as the merge reaches them
+def iter_messages(conn, conversation_ids, since_id: int = 0):
+    blocks = conn.execute(
+        select(ArchiveBlock)
+        .where(ArchiveBlock.conversation_id.in_(conversation_ids), ArchiveBlock.last_id > since_id)
+        .order_by(ArchiveBlock.conversation_id, ArchiveBlock.first_id)
+    ).all()
+    by_conversation = {}
+    for block in blocks:
+        by_conversation.setdefault(block.conversation_id, []).append(block)
+
+    def one_conversation(blocks):
+        for block in blocks:
+            for message in read_block(block):
+                if message["id"] > since_id:
+                    yield message
+
+    return heapq.merge(*(one_conversation(blocks) for blocks in by_conversation.values()), key=lambda message: message["id"])
+
+# deletes the index rows of up to limit blocks whose newest message is older than cutoff,
+# in one transaction, then the segment files that have no blocks left
+# returns (messages, blocks, segment files) deleted
+# only segments that lost a block here are checked, so a segment written by a running
+# archiver whose index rows aren't committed yet is never touched
+def delete_blocks_before(engine, cutoff: datetime, limit: int, directory: str = ARCHIVE_DIR):
+    with engine.begin() as conn:
+        blocks = conn.execute(
+            select(ArchiveBlock.id, ArchiveBlock.segment, ArchiveBlock.count)
+            .where(ArchiveBlock.last_timestamp < cutoff)
+            .order_by(ArchiveBlock.last_timestamp)
+            .limit(limit)
+        ).all()
+        if not blocks:
+            return 0, 0, 0
+        conn.execute(delete(ArchiveBlock).where(ArchiveBlock.id.in_([block.id for block in blocks])))
+        segments = {block.segment for block in blocks}
+        still_used = set(conn.execute(
+            select(ArchiveBlock.segment).where(ArchiveBlock.segment.in_(segments)).distinct()
+        ).scalars())
+    unused = segments - still_used
+    for segment in unused:
+        (Path(directory) / segment).unlink(missing_ok=True)
+    return sum(block.count for block in blocks), len(blocks), len(unused)
+
+# (messages, blocks) that delete_blocks_before would delete for cutoff
+def count_blocks_before(conn, cutoff: datetime):
+    row = conn.execute(
+        select(func.coalesce(func.sum(ArchiveBlock.count), 0), func.count())
+        .where(ArchiveBlock.last_timestamp < cutoff)
+    ).one()
+    return row[0], row[1]
+
+class Archiver():
+    # get_engine is called on every run, so creating an archiver doesn't open the database
+    def __init__(self, get_engine, directory: str = ARCHIVE_DIR, archive_after: timedelta = ARCHIVE_AFTER,
+                 block_size: int = BLOCK_SIZE, segment_size: int = SEGMENT_SIZE, interval: float = INTERVAL):
+        self.get_engine = get_engine
+        self.directory = directory
+        self.archive_after = archive_after
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        # metrics
+        self.runs = 0
+        self.archived = 0
+        self.segments_written = 0
+        self.conflicts = 0
+        self.last_run = None
+
+    # (conversation id, highest seq to archive) of every conversation with messages older than cutoff
+    # the newest message of a conversation is never archived
+    @staticmethod
+    def _candidates(conn, cutoff: datetime) -> list:
+        upto = func.min(func.max(Message.seq), Conversation.last_seq - 1)
+        return conn.execute(
+            select(Message.conversation_id, upto)
+            .join(Conversation, Conversation.id == Message.conversation_id)
+            .where(Message.timestamp < cutoff)
+            .group_by(Message.conversation_id)
+            .having(upto >= func.min(Message.seq))
+        ).all()
+
+    # moves the messages older than archive_after into segment files, returns how many were moved
+    # one segment (at most segment_size messages) per transaction
+    # the database and file work runs through blocking.run_blocking, the pauses between segments don't
+    def run(self, now: datetime = None) -> int:
+        with self.lock:
+            cutoff = (now or datetime.utcnow()) - self.archive_after
+            engine = self.get_engine()
+            archived = 0
+            while True:
+                candidates = blocking.run_blocking(self._find_candidates, engine, cutoff)
+                if not candidates:
+                    break
+                try:
+                    archived += blocking.run_blocking(self._archive_segment, engine, candidates)
+                except ArchiveConflict:
+                    # another worker archived (or deleted) the same messages first
+                    self.conflicts += 1
+                    break
+                time.sleep(PAUSE)
+            self.runs += 1
+            self.archived += archived
+            self.last_run = datetime.utcnow().isoformat()
+            return archived
+
+    def _find_candidates(self, engine, cutoff: datetime) -> list:
+        with engine.connect() as conn:
+            return self._candidates(conn, cutoff)
+
+    def _archive_segment(self, engine, candidates) -> int:
+        writer = SegmentWriter(self.directory)
+        entries = []
+        try:
+            with engine.connect() as conn:
+                for cid, upto in candidates:
+                    room = self.segment_size - sum(entry["count"] for entry in entries)
+                    if room <= 0:
+                        break
+                    rows = conn.execute(
+                        select(*(getattr(Message, field) for field in FIELDS))
+                        .where(Message.conversation_id == cid, Message.seq <= upto)
+                        .order_by(Message.seq.asc())
+                        .limit(room)
+                    ).all()
+                    for start in range(0, len(rows), self.block_size):
+                        entries.append(writer.add_block(cid, rows[start:start + self.block_size]))
+            if not entries:
+                writer.abort()
+                return 0
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+        total = sum(entry["count"] for entry in entries)
+        try:
+            with engine.begin() as conn:
+                deleted = conn.execute(
+                    text("DELETE FROM messages WHERE conversation_id = :conversation_id "
+                         "AND seq BETWEEN :first_seq AND :last_seq"),
+                    [{key: entry[key] for key in ("conversation_id", "first_seq", "last_seq")} for entry in entries],
+                ).rowcount
+                if deleted != total:
+                    raise ArchiveConflict(f"expected to archive {total} messages, found {deleted}")
+                conn.execute(insert(ArchiveBlock), entries)
+        except BaseException:
+            # nothing refers to the segment, the messages are still in the table
+            (Path(self.directory) / writer.name).unlink(missing_ok=True)
+            raise
+        self.segments_written += 1
+        logger.info("Archived %d messages into %s", total, writer.name)
+        return total
+
+    # the archiving thread is started on first use in every process, threads don't survive a fork
+    def start(self):
+        if self.thread_pid == os.getpid() or self.interval <= 0:
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self._run_forever, name="message-archiver", daemon=True)
+        self.thread.start()
+
+    def _run_forever(self):
+        # spreads the runs of several workers out instead of running them all at once
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.exception("Archiving messages failed")
+            time.sleep(self.interval)
+
+    def _count_archive(self):
+        with self.get_engine().connect() as conn:
+            return conn.execute(
+                select(func.count(func.distinct(ArchiveBlock.segment)), func.count(), func.coalesce(func.sum(ArchiveBlock.count), 0))
+            ).one()
+
+    # the engine is the one the archiving runs on, so it is only used from native threads as well
+    def stats(self) -> dict:
+        row = blocking.run_blocking(self._count_archive)
+        return {
+            "segments": row[0],
+            "blocks": row[1],
+            "messages": row[2],
+            "runs": self.runs,
+            "archived": self.archived,
+            "segments_written": self.segments_written,
+            "conflicts": self.conflicts,
+            "last_run": self.last_run,
+            "block_cache": block_cache.stats(),
+        }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "run":
+        print("usage: python3 archive.py run [days]")
+        sys.exit(1)
+    import db
+    archive_after = timedelta(days=float(sys.argv[2])) if len(sys.argv) > 2 else ARCHIVE_AFTER
+    archived = Archiver(db.get_engine, archive_after=archive_after).run()
+    print(f"archived {archived} messages")
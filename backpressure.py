@@ -0,0 +1,89 @@
+'''
+backpressure
+per-user rate limits on inbound socket events
+
+every user gets a token bucket per event type, an event takes one token and is refused
+when the bucket is empty, tokens come back at a steady rate up to the bucket size,
+so short bursts are fine but a client can't flood the server
+
+the outbound side (slow readers) is handled in outbound.py
+'''
+
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+# event -> (tokens per second, bucket size)
+LIMITS = {
+    "send": (float(os.environ.get("SEND_RATE", 5)), float(os.environ.get("SEND_BURST", 20))),
+    "join": (float(os.environ.get("JOIN_RATE", 1)), float(os.environ.get("JOIN_BURST", 5))),
+}
+# once there are this many buckets, full (idle) ones are dropped
+MAX_IDLE_BUCKETS = 10000
+
+class TokenBucket():
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens: float = 1) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class RateLimiter():
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = LIMITS, max_idle_buckets: int = MAX_IDLE_BUCKETS):
+        self.limits = dict(limits)
+        self.max_idle_buckets = max_idle_buckets
+        self.lock = threading.Lock()
+        # (username, event) -> bucket
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        # event -> counters
+        self.allowed = {event: 0 for event in self.limits}
+        self.throttled = {event: 0 for event in self.limits}
+
+    # True if the user may send this event now, events without a limit are always allowed
+    def allow(self, username: str, event: str) -> bool:
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        with self.lock:
+            bucket = self.buckets.get((username, event))
+            if bucket is None:
+                if len(self.buckets) >= self.max_idle_buckets:
+                    self._drop_idle()
+                bucket = self.buckets[(username, event)] = TokenBucket(*limit)
+            if bucket.take():
+                self.allowed[event] += 1
+                return True
+            self.throttled[event] += 1
+            return False
+
+    # a full bucket behaves exactly like a new one, so it can be forgotten
+    def _drop_idle(self):
+        for key in [key for key, bucket in self.buckets.items() if bucket.is_full()]:
+            del self.buckets[key]
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self.buckets),
+            "allowed": dict(self.allowed),
+            "throttled": dict(self.throttled),
+        }
+
+limiter = RateLimiter()
@@ -0,0 +1,44 @@
+'''
+blocking
+helpers for running the server on green threads (eventlet or gevent)
+
+the async mode is picked with the ASYNC_MODE environment variable:
+    threading (default)  one OS thread per connection, werkzeug server, fine for development
+    eventlet / gevent    green threads, thousands of idle websockets per worker
+
+green threads only switch on I/O that has been monkey patched, so this module
+has to be imported before anything else (it patches the standard library on import),
+and CPU heavy calls such as bcrypt have to run in a real OS thread through run_blocking
+or they freeze every connection of the worker while they run
+
+Flask-SocketIO is a WSGI extension, so the asyncio server mode of python-socketio
+is not available here, eventlet and gevent are the event loop options
+'''
+
+import os
+
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "threading")
+if ASYNC_MODE not in ("threading", "eventlet", "gevent"):
+    raise ValueError(f"Unknown ASYNC_MODE {ASYNC_MODE!r}, expected threading, eventlet or gevent")
+
+GREEN = ASYNC_MODE != "threading"
+
+if ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+# runs fn in a native OS thread and waits for the result, only the calling green thread waits
+# in threading mode it is a plain call
+# fn must not touch state guarded by (patched) locks that green threads use at the same time,
+# patched locks are only safe between green threads
+def run_blocking(fn, *args, **kwargs):
+    if ASYNC_MODE == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    if ASYNC_MODE == "gevent":
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
@@ -0,0 +1,83 @@
+'''
+connections
+per-socket connection context
+
+when a socket connects, the user is looked up once from the Flask session, and the
+username, a snapshot of the user's friends and the rooms the socket has joined
+are kept here until it disconnects, so later socket events need no identity or friendship queries
+
+the snapshot is not refreshed by itself, whatever changes a friendship has to call
+friendship_changed (app.py does it for local changes and for changes announced
+by other workers)
+'''
+
+import threading
+from typing import Dict, Optional, Set
+
+class ConnectionContext():
+    def __init__(self, sid: str, username: str, friends: Set[str]):
+        self.sid = sid
+        self.username = username
+        self.friends = friends
+        # room id -> the other user in that conversation
+        self.rooms: Dict[int, str] = {}
+
+    def is_friend(self, username: str) -> bool:
+        return username in self.friends
+
+    def __repr__(self):
+        return f"<ConnectionContext(sid={self.sid}, username={self.username}, rooms={list(self.rooms)})>"
+
+class ConnectionRegistry():
+    def __init__(self):
+        self.lock = threading.RLock()
+        # socket id -> context
+        self.contexts: Dict[str, ConnectionContext] = {}
+        # username -> socket ids of that user in this process
+        self.user_sids: Dict[str, Set[str]] = {}
+
+    def open(self, sid: str, username: str, friends) -> ConnectionContext:
+        context = ConnectionContext(sid, username, set(friends))
+        with self.lock:
+            self.contexts[sid] = context
+            self.user_sids.setdefault(username, set()).add(sid)
+        return context
+
+    def get(self, sid: str) -> Optional[ConnectionContext]:
+        return self.contexts.get(sid)
+
+    def close(self, sid: str) -> Optional[ConnectionContext]:
+        with self.lock:
+            context = self.contexts.pop(sid, None)
+            if context is not None:
+                sids = self.user_sids.get(context.username)
+                if sids is not None:
+                    sids.discard(sid)
+                    if not sids:
+                        del self.user_sids[context.username]
+            return context
+
+    def of_user(self, username: str):
+        with self.lock:
+            return [self.contexts[sid] for sid in self.user_sids.get(username, ())]
+
+    # updates the friend snapshot of both users' connections
+    # returns the (context, room id) pairs of conversations that are no longer allowed,
+    # the caller takes those sockets out of the socket.io rooms
+    def friendship_changed(self, action: str, username: str, friend_username: str):
+        revoked = []
+        with self.lock:
+            for user, friend in ((username, friend_username), (friend_username, username)):
+                for context in self.of_user(user):
+                    if action == "add":
+                        context.friends.add(friend)
+                        continue
+                    context.friends.discard(friend)
+                    for room_id, peer in list(context.rooms.items()):
+                        if peer == friend:
+                            del context.rooms[room_id]
+                            revoked.append((context, room_id))
+        return revoked
+
+    def stats(self) -> dict:
+        return {"connections": len(self.contexts), "users": len(self.user_sids)}
@@ -3,70 +3,222 @@ db
 database file, containing all the logic to interface with the sql database
 '''
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import DateTime, and_, bindparam, create_engine, delete, event, exists, literal, or_, select, text, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, configure_mappers
+from sqlalchemy.pool import StaticPool
 from models import *
+from friend_graph import FriendGraph
+import archive
+import migrations
 
 from pathlib import Path
+import heapq
+import itertools
+import os
 import sqlite3
+import threading
 
-# creates the database directory
-Path("database") \
-    .mkdir(exist_ok=True)
+# sqlite tuning profiles, the profile is picked with the DB_PROFILE environment variable
+# every pragma in a profile is applied to each new pooled connection
+# WAL lets readers (friend list, articles) carry on while a chat message is being written
+ENGINE_PROFILES = {
+    # WAL, but every commit is still fsynced before it returns
+    "durable": {
+        "url": "sqlite:///database/main.db",
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "FULL",
+            "busy_timeout": 5000,
+            "cache_size": -16000,  # negative values are in KiB, so 16MB
+            "temp_store": "MEMORY",
+            "mmap_size": 64 * 1024 * 1024,
+        },
+    },
+    # WAL with synchronous=NORMAL, only the WAL checkpoint fsyncs
+    # a power cut can lose the last few commits but never corrupts the database
+    "throughput": {
+        "url": "sqlite:///database/main.db",
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "cache_size": -64000,
+            "temp_store": "MEMORY",
+            "mmap_size": 256 * 1024 * 1024,
+        },
+    },
+    # a single in-memory database shared by every thread, nothing touches the disk
+    "memory": {
+        "url": "sqlite://",
+        "pragmas": {
+            "synchronous": "OFF",
+            "temp_store": "MEMORY",
+        },
+        "poolclass": StaticPool,
+    },
+}
+ENGINE_PROFILES["test"] = ENGINE_PROFILES["memory"]
+
+DEFAULT_PROFILE = "throughput"
+
+def make_engine(profile_name: str = None, echo: bool = False):
+    profile_name = profile_name or os.environ.get("DB_PROFILE", DEFAULT_PROFILE)
+    if profile_name not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {profile_name!r}, expected one of {sorted(ENGINE_PROFILES)}")
+    profile = ENGINE_PROFILES[profile_name]
+
+    if profile["url"].startswith("sqlite:///"):
+        # creates the database directory
+        Path(profile["url"][len("sqlite:///"):]).parent.mkdir(exist_ok=True)
+
+    kwargs = {"echo": echo}
+    if "poolclass" in profile:
+        kwargs["poolclass"] = profile["poolclass"]
+        kwargs["connect_args"] = {"check_same_thread": False}
+    new_engine = create_engine(profile["url"], **kwargs)
+
+    @event.listens_for(new_engine, "connect")
+    def apply_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in profile["pragmas"].items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    new_engine.profile_name = profile_name
+    return new_engine
+
+# the engine is created on first use instead of on import, so importing db has no side effects
+# and a process that never touches the database never opens it
+_engine = None
+_engine_lock = threading.Lock()
 
 # "database/main.db" specifies the database file
-# change it if you wish
+# change it in ENGINE_PROFILES if you wish
 # turn echo = True to display the sql output
-engine = create_engine("sqlite:///database/main.db", echo=False)
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                new_engine = make_engine(echo=False)
+                # initializes the database
+                Base.metadata.create_all(new_engine)
+                # brings existing databases up to date (indexes etc.), see migrations/__init__.py
+                migrations.upgrade(new_engine)
+                _engine = new_engine
+    return _engine
+
+# db.engine still works for code outside this module
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# a forked child must not use the sqlite connections pooled by its parent,
+# so the child's pool is emptied (without closing the parent's connections)
+# this runs after every os.fork, whichever server does the forking
+def _dispose_after_fork():
+    if _engine is not None:
+        _engine.dispose(close=False)
+    if _background_engine is not None:
+        _background_engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_after_fork)
+
+# in-memory copy of the friendship table, see friend_graph.py
+friend_graph = FriendGraph()
+
+def _friendship_rows():
+    with get_engine().connect() as conn:
+        return conn.execute(select(user_friend_table.c.user_username, user_friend_table.c.friend_username)).all()
+
+# returns the friend graph, loading it from the database the first time
+def get_friend_graph() -> FriendGraph:
+    friend_graph.ensure_loaded(_friendship_rows)
+    return friend_graph
 
-# initializes the database
-Base.metadata.create_all(engine)
+# indexes that nearly every request reads, they are read once during warm_up
+# so their pages are in the OS cache before the first user arrives
+HOT_INDEXES = {
+    "ix_messages_sender_receiver_id": "messages",
+    "ix_friend_request_to_status": "friend_request",
+}
+
+# does the first-request work up front: opens the database (creating and migrating it),
+# configures the ORM mappers, reads the hot indexes and loads the friend graph
+# the app runs this before forking workers, which then share the result
+def warm_up():
+    configure_mappers()
+    with get_engine().connect() as conn:
+        for index, table in HOT_INDEXES.items():
+            conn.execute(text(f"SELECT COUNT(*) FROM {table} INDEXED BY {index}"))
+    get_friend_graph()
 
 # inserts a user to the database
-def insert_user(username: str, password: str):
-    with Session(engine) as session:
-        user = User(username=username, password=password)
-        session.add(user)
-        session.commit()
+# returns False instead of raising when the username is already taken,
+# so signing up is a single INSERT ... ON CONFLICT DO NOTHING
+def insert_user(username: str, password: str) -> bool:
+    with get_engine().begin() as conn:
+        result = conn.execute(
+            sqlite_insert(User).values(username=username, password=password).on_conflict_do_nothing()
+        )
+        return result.rowcount == 1
+
+# replaces a user's password hash, used to upgrade hashes to the current bcrypt work factor
+def update_password(username: str, password: str):
+    with get_engine().begin() as conn:
+        conn.execute(update(User).where(User.username == username).values(password=password))
 
 # gets a user from the database
 def get_user(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.get(User, username)
 
+# EXISTS clause for a username, used to fold existence checks into other statements
+def _user_exists(username):
+    return exists().where(User.username == username)
+
 def check_user_exists(username):
     # Implement logic to check if the user exists in the database
     # Return True if the user exists, False otherwise
-    user = get_user(username)
-    return user is not None
+    with get_engine().connect() as conn:
+        return conn.execute(select(_user_exists(username))).scalar()
 
+# the request is only inserted when both users exist and there is no request
+# between them yet, all checked inside one INSERT ... SELECT ... ON CONFLICT
+# the extra query to work out what went wrong only runs when nothing was inserted
+# remove_friend leaves the accepted request behind, so once the two aren't friends
+# any more an accepted request is turned back into a pending one
 def add_friend_request(from_username: str, to_username: str):
-    with Session(engine) as session:
-        # Check if both users exist
-        user = session.query(User).filter_by(username=from_username).first()
-        friend = session.query(User).filter_by(username=to_username).first()
-        
-        if not user or not friend:
+    # accepted requests are deleted after a while (see retention.py), so an existing
+    # request can't be relied on to stop friends from asking again
+    if check_friends(from_username, to_username):
+        return False, "Already friends"
+    statement = sqlite_insert(FriendRequest).from_select(
+        ["from_username", "to_username", "status", "updated_at"],
+        select(literal(from_username), literal(to_username), literal("pending"), literal(datetime.utcnow(), DateTime))
+        .where(_user_exists(from_username), _user_exists(to_username)),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[FriendRequest.from_username, FriendRequest.to_username],
+        set_={"status": statement.excluded.status, "updated_at": statement.excluded.updated_at},
+        where=FriendRequest.status == 'accepted',
+    )
+    with get_engine().begin() as conn:
+        result = conn.execute(statement)
+        if result.rowcount == 1:
+            return True, None
+
+        users_exist = conn.execute(
+            select(and_(_user_exists(from_username), _user_exists(to_username)))
+        ).scalar()
+        if not users_exist:
             return False, "One or both users do not exist"
-        
-        # Check if a friend request already exists
-        existing_request = session.query(FriendRequest).filter(
-            FriendRequest.from_username == from_username,
-            FriendRequest.to_username == to_username,
-            FriendRequest.status == 'pending'
-        ).first()
-        
-        if existing_request:
-            return False, "Friend request already sent"
-        
-        # Create a new friend request
-        new_request = FriendRequest(from_username=from_username, to_username=to_username)
-        session.add(new_request)
-        session.commit()
-        return True, None
+        return False, "Friend request already sent"
 
 def get_pending_friend_requests(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         pending_requests = session.query(FriendRequest).filter(
             FriendRequest.to_username == username,
             FriendRequest.status == 'pending'
@@ -74,122 +226,391 @@ def get_pending_friend_requests(username: str):
         return [(request.from_username, request.to_username) for request in pending_requests]
 
 def send_friend_request(from_username, to_username):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         request = FriendRequest(from_username=from_username, to_username=to_username)
         session.add(request)
         session.commit()
 
+# marks the request accepted and stores the friendship in both directions,
+# one UPDATE and one INSERT in the same transaction, no user rows or friend lists are loaded
 def accept_friend_request(from_username: str, to_username: str):
-    with Session(engine) as session:
-        # Find the request
-        request = session.query(FriendRequest).filter(
-            FriendRequest.from_username == from_username,
-            FriendRequest.to_username == to_username,
-            FriendRequest.status == 'pending'
-        ).first()
-        
-        if request:
-            # Accept the request
-            request.status = 'accepted'
-            session.commit()
-            
-            # Add the friendship
-            user = session.query(User).filter(User.username == from_username).first()
-            friend = session.query(User).filter(User.username == to_username).first()
-            if user and friend:
-                user.friends.append(friend)
-                friend.friends.append(user)
-                session.commit()
-            return True
-        else:
+    with get_engine().begin() as conn:
+        result = conn.execute(
+            update(FriendRequest)
+            .where(
+                FriendRequest.from_username == from_username,
+                FriendRequest.to_username == to_username,
+                FriendRequest.status == 'pending',
+            )
+            .values(status='accepted', updated_at=datetime.utcnow())
+        )
+        if result.rowcount == 0:
             return False, "Request not found"
 
+        conn.execute(
+            sqlite_insert(user_friend_table)
+            .values([
+                {"user_username": from_username, "friend_username": to_username},
+                {"user_username": to_username, "friend_username": from_username},
+            ])
+            .on_conflict_do_nothing()
+        )
+    friend_graph.add_friendship(from_username, to_username)
+    return True
+
 def decline_friend_request(from_username: str, to_username: str):
-    with Session(engine) as session:
-        # Find the request
-        request = session.query(FriendRequest).filter(
-            FriendRequest.from_username == from_username,
-            FriendRequest.to_username == to_username,
-            FriendRequest.status == 'pending'
-        ).first()
-        
-        if request:
-            # Decline the request
-            session.delete(request)
-            session.commit()
-            return True
-        else:
+    with get_engine().begin() as conn:
+        result = conn.execute(
+            delete(FriendRequest).where(
+                FriendRequest.from_username == from_username,
+                FriendRequest.to_username == to_username,
+                FriendRequest.status == 'pending',
+            )
+        )
+        if result.rowcount == 0:
             return False, "Request not found"
+        return True
 
 def get_confirmed_friends(username: str):
-    with Session(engine) as session:
-        user = session.query(User).filter(User.username == username).first()
-        if user:
-            return [(user.username, friend.username) for friend in user.friends]
-        return []
+    return [(username, friend) for friend in get_friend_graph().friends_of(username)]
 
+# deletes both directions of the friendship with a single DELETE
 def remove_friend(username: str, friend_username: str):
-    with Session(engine) as session:
-        user = session.query(User).filter_by(username=username).first()
-        friend = session.query(User).filter_by(username=friend_username).first()
-            
-        if not user or not friend:
-            return False, "User does not exist"
-     
-        if friend not in user.friends:
+    with get_engine().begin() as conn:
+        result = conn.execute(
+            delete(user_friend_table).where(or_(
+                and_(user_friend_table.c.user_username == username,
+                     user_friend_table.c.friend_username == friend_username),
+                and_(user_friend_table.c.user_username == friend_username,
+                     user_friend_table.c.friend_username == username),
+            ))
+        )
+        if result.rowcount == 0:
+            users_exist = conn.execute(
+                select(and_(_user_exists(username), _user_exists(friend_username)))
+            ).scalar()
+            if not users_exist:
+                return False, "User does not exist"
             return False, "User is not in the friend list"
-            
-        # Remove friend relationship
-        user.friends.remove(friend)
-        friend.friends.remove(user)
-        session.commit()
-        return True, None
+    friend_graph.remove_friendship(username, friend_username)
+    return True, None
 
+# answered from the in-memory friend graph, no database access
 def check_friends(user1_username, user2_username):
-    with Session(engine) as session:
-        user1 = session.query(User).filter_by(username=user1_username).first()
-        user2 = session.query(User).filter_by(username=user2_username).first()
-        if user1 is None or user2 is None:
-            return False
-        return user1 in user2.friends
+    return get_friend_graph().are_friends(user2_username, user1_username)
     
 # 插入消息到数据库
-def insert_message(sender: str, receiver: str, message: str):
-    with Session(engine) as session:
-        new_message = Message(sender=sender, receiver=receiver, message=message)
-        session.add(new_message)
-        session.commit()
+def insert_message(sender: str, receiver: str, message: str, client_key: str = None):
+    insert_messages([{
+        "sender": sender,
+        "receiver": receiver,
+        "message": message,
+        "timestamp": datetime.utcnow(),
+        "client_key": client_key,
+    }])
+
+# every message gets the next sequence number of its conversation, read and written by
+# the same statement, so it runs under sqlite's write lock and two workers can't take
+# the same number. OR IGNORE skips a message whose (sender, client_key) is already stored
+# the conversation row remembers the last seq, so numbering carries on even when
+# retention.py has deleted every message of the conversation that was still in the table
+_insert_message_statement = text(
+    "INSERT OR IGNORE INTO messages (sender, receiver, message, timestamp, conversation_id, seq, client_key) "
+    "SELECT :sender, :receiver, :message, :timestamp, :conversation_id, "
+    "MAX(COALESCE(MAX(seq), 0), COALESCE((SELECT last_seq FROM conversation WHERE id = :conversation_id), 0)) + 1, "
+    ":client_key "
+    "FROM messages WHERE conversation_id = :conversation_id"
+).bindparams(bindparam("timestamp", type_=DateTime))
+
+# the conversation rows are brought up to date in the same transaction as the messages
+# the messages with a seq above the row's last_seq are exactly the ones this transaction added
+# (messages ignored as duplicates don't get a seq), so they are what the unread counters grow by
+# every expression on the right sees the row as it was before the update
+_create_conversation_statement = text(
+    "INSERT OR IGNORE INTO conversation (id, user_a, user_b, last_seq, unread_a, unread_b) "
+    "VALUES (:id, :user_a, :user_b, 0, 0, 0)"
+)
+_update_conversation_statement = text(
+    "UPDATE conversation SET "
+    "unread_a = unread_a + (SELECT COUNT(*) FROM messages WHERE conversation_id = :id "
+    "AND seq > conversation.last_seq AND receiver = conversation.user_a AND sender != receiver), "
+    "unread_b = unread_b + (SELECT COUNT(*) FROM messages WHERE conversation_id = :id "
+    "AND seq > conversation.last_seq AND receiver = conversation.user_b AND sender != receiver), "
+    "(last_message_id, last_seq, last_sender, last_preview, last_timestamp) = ("
+    "SELECT id, seq, sender, substr(message, 1, 100), timestamp FROM messages "
+    "WHERE conversation_id = :id ORDER BY seq DESC LIMIT 1) "
+    "WHERE id = :id"
+)
+# the messages this transaction added, read before the conversation rows move last_seq past them
+_new_messages_statement = text(
+    "SELECT messages.conversation_id, messages.client_key, messages.seq FROM messages "
+    "JOIN conversation ON conversation.id = messages.conversation_id "
+    "WHERE messages.conversation_id IN :ids AND messages.seq > conversation.last_seq "
+    "ORDER BY messages.seq"
+).bindparams(bindparam("ids", expanding=True))
+
+# inserts a batch of messages in a single transaction
+# rows is a list of dicts with sender, receiver, message, timestamp and (optionally) client_key keys,
+# passing a list makes sqlalchemy use executemany so the whole batch costs one commit
+# resending a batch is harmless, messages that carry a client_key are only stored once
+# returns (conversation_id, client_key, seq) of the messages that were stored, oldest first
+def insert_messages(rows: list, using=None):
+    if not rows:
+        return []
+    rows = [{
+        **row,
+        "conversation_id": conversation_id(row["sender"], row["receiver"]),
+        "client_key": row.get("client_key"),
+    } for row in rows]
+    conversations = {}
+    for row in rows:
+        user_a, user_b = sorted((row["sender"], row["receiver"]))
+        conversations[row["conversation_id"]] = {"id": row["conversation_id"], "user_a": user_a, "user_b": user_b}
+    with (using or get_engine()).begin() as conn:
+        conn.execute(_insert_message_statement, rows)
+        conn.execute(_create_conversation_statement, list(conversations.values()))
+        stored = conn.execute(_new_messages_statement, {"ids": list(conversations)}).all()
+        conn.execute(_update_conversation_statement, [{"id": cid} for cid in conversations])
+    return [tuple(row) for row in stored]
+
+# the background message writer gets an engine of its own, so its commits never wait on
+# (or share pool locks with) the request handlers, which matters when the commit runs
+# in a native thread under eventlet/gevent
+# the in-memory profile has to share the single connection that holds the database
+def make_writer_engine():
+    engine = get_engine()
+    if isinstance(engine.pool, StaticPool):
+        return engine
+    return make_engine(engine.profile_name)
+
+# the archiver and the retention sweeper run their statements in native threads under
+# eventlet/gevent too (see blocking.run_blocking), so they share an engine of their own
+# whose pool locks no green thread ever waits on
+_background_engine = None
+
+def get_background_engine():
+    global _background_engine
+    if _background_engine is None:
+        # opens (and migrates) the database first, make_writer_engine needs it
+        get_engine()
+        with _engine_lock:
+            if _background_engine is None:
+                _background_engine = make_writer_engine()
+    return _background_engine
 
 # 获取某个用户的所有消息
 def get_messages(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         messages = session.query(Message).filter(
             Message.receiver == username
         ).order_by(Message.timestamp.asc()).all()
         return [(msg.sender, msg.message, msg.timestamp) for msg in messages]
     
+# largest page get_conversation_page will return, whatever the caller asks for
+MAX_PAGE_SIZE = 200
+
+# the columns every message read returns, see _message_row
+_MESSAGE_COLUMNS = (Message.id, Message.sender, Message.receiver, Message.message, Message.timestamp,
+                    Message.seq, Message.client_key)
+
+def _message_row(row) -> dict:
+    return {
+        "id": row.id,
+        "sender": row.sender,
+        "receiver": row.receiver,
+        "message": row.message,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+        "seq": row.seq,
+        "client_key": row.client_key,
+    }
+
+# reads that combine the archive and the messages table have to see both from one snapshot,
+# or messages an archiver moves in between show up in neither (or in both)
+# pysqlite only opens a transaction before a write, so the read transaction is begun by hand,
+# WAL then gives every SELECT on the connection the same snapshot until it is returned to the pool
+# the in-memory profile shares its one connection with the writer, and has no other process to race
+def _begin_snapshot(conn):
+    if not isinstance(conn.engine.pool, StaticPool):
+        conn.exec_driver_sql("BEGIN")
+
+# gets one page of the conversation between user_a and user_b, newest message first
+# before_id is the id of the oldest message the caller already has (None for the latest page),
+# paging on the id instead of OFFSET keeps every page a range scan on messages(sender, receiver, id),
+# so the 1000th page costs the same as the first one
+# once the table runs out, the page continues with archived messages, see archive.py
+def get_conversation_page(user_a: str, user_b: str, before_id: int = None, limit: int = 50):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # one index range per direction, each already limited, merged below
+    def one_direction(sender, receiver):
+        query = select(*_MESSAGE_COLUMNS) \
+            .where(Message.sender == sender, Message.receiver == receiver)
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        return select(query.order_by(Message.id.desc()).limit(limit).subquery())
+
+    if user_a == user_b:
+        query = one_direction(user_a, user_b)
+    else:
+        merged = union_all(one_direction(user_a, user_b), one_direction(user_b, user_a)).subquery()
+        query = select(merged).order_by(merged.c.id.desc()).limit(limit)
+
+    with get_engine().connect() as conn:
+        _begin_snapshot(conn)
+        messages = [_message_row(row) for row in conn.execute(query)]
+        # every archived message of a conversation is older than the ones left in the table
+        if len(messages) < limit:
+            oldest_id = messages[-1]["id"] if messages else before_id
+            messages += archive.read_before(conn, conversation_id(user_a, user_b), oldest_id, limit - len(messages))
+    return messages
+
+# the messages of the conversation between user_a and user_b that come after since_seq, oldest first
+# this is what a reconnecting client asks for, so it costs as much as the number of missed
+# messages (a range scan on messages(conversation_id, seq)) instead of the whole history
+# has_more is True when there are more than limit of them, the client then asks again
+# a client that has been away long enough gets the archived messages first
+def get_conversation_since(user_a: str, user_b: str, since_seq: int, limit: int = MAX_PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    room_id = conversation_id(user_a, user_b)
+    with get_engine().connect() as conn:
+        _begin_snapshot(conn)
+        messages = archive.read_since(conn, room_id, since_seq, limit + 1)
+        if len(messages) <= limit:
+            query = select(*_MESSAGE_COLUMNS) \
+                .where(Message.conversation_id == room_id, Message.seq > since_seq) \
+                .order_by(Message.seq.asc()) \
+                .limit(limit + 1 - len(messages))
+            messages += [_message_row(row) for row in conn.execute(query)]
+    return {"messages": messages[:limit], "has_more": len(messages) > limit}
+
+# number of conversations per inbox page
+INBOX_PAGE_SIZE = 20
+
+# one page of username's conversations, the most recently active first
+# before is the last_message_id of the last conversation the caller already has (None for the first page),
+# each side of the pair is one range scan on its (user, last_message_id) index,
+# so a page costs the same however many messages or conversations the user has
+def get_inbox(username: str, before: int = None, limit: int = INBOX_PAGE_SIZE) -> dict:
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    def one_side(user_column, unread_column, peer_column):
+        query = select(
+            Conversation.id, Conversation.last_message_id, Conversation.last_sender,
+            Conversation.last_preview, Conversation.last_timestamp,
+            unread_column.label("unread"), peer_column.label("peer"),
+        ).where(user_column == username, Conversation.last_message_id.is_not(None))
+        if user_column is Conversation.user_b:
+            # a conversation with yourself is already on the user_a side
+            query = query.where(Conversation.user_a != username)
+        if before is not None:
+            query = query.where(Conversation.last_message_id < before)
+        return select(query.order_by(Conversation.last_message_id.desc()).limit(limit + 1).subquery())
+
+    merged = union_all(
+        one_side(Conversation.user_a, Conversation.unread_a, Conversation.user_b),
+        one_side(Conversation.user_b, Conversation.unread_b, Conversation.user_a),
+    ).subquery()
+    query = select(merged).order_by(merged.c.last_message_id.desc()).limit(limit + 1)
+    with get_engine().connect() as conn:
+        rows = conn.execute(query).all()
+
+    conversations = [{
+        "peer": row.peer,
+        "unread": row.unread,
+        "last_message": {
+            "id": row.last_message_id,
+            "sender": row.last_sender,
+            "preview": row.last_preview,
+            "timestamp": row.last_timestamp.isoformat() if row.last_timestamp else None,
+        },
+    } for row in rows[:limit]]
+    has_more = len(rows) > limit
+    return {
+        "conversations": conversations,
+        "has_more": has_more,
+        "next_before": conversations[-1]["last_message"]["id"] if has_more else None,
+    }
+
+# clears username's unread counter of the conversation with peer
+def mark_read(username: str, peer: str):
+    user_a, user_b = sorted((username, peer))
+    unread = Conversation.unread_a if username == user_a else Conversation.unread_b
+    with get_engine().begin() as conn:
+        conn.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id(username, peer), unread != 0)
+            .values({unread: 0})
+        )
+
+# streams the messages sent or received by username in id order, starting after since_id
+# peer narrows it down to the conversation with one other user
+# the rows are read from the cursor yield_per at a time, so even a full export
+# holds only one chunk in memory, the connection stays open until the generator is closed
+# archived messages are merged in by id, reading one block per conversation at a time
+def iter_messages(username: str, peer: str = None, since_id: int = 0, limit: int = None, yield_per: int = 500):
+    if peer is None:
+        condition = or_(Message.sender == username, Message.receiver == username)
+        conversations = select(Conversation.id).where(or_(Conversation.user_a == username, Conversation.user_b == username))
+    else:
+        condition = or_(
+            and_(Message.sender == username, Message.receiver == peer),
+            and_(Message.sender == peer, Message.receiver == username),
+        )
+        conversations = [conversation_id(username, peer)]
+    query = select(*_MESSAGE_COLUMNS) \
+        .where(condition, Message.id > since_id) \
+        .order_by(Message.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+
+    with get_engine().connect() as conn:
+        _begin_snapshot(conn)
+        archived = archive.iter_messages(conn, conversations, since_id)
+        rows = (_message_row(row) for row in conn.execution_options(yield_per=yield_per).execute(query))
+        yield from itertools.islice(heapq.merge(archived, rows, key=lambda message: message["id"]), limit)
+
 # 插入新的文章到数据库
 def create_article(title: str, content: str, author: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         new_article = Article(title=title, content=content, author=author)
         session.add(new_article)
         session.commit()
 
 # 获取所有文章
 def get_all_articles():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         articles = session.query(Article).all()
         return [{'id': article.id, 'title': article.title, 'content': article.content, 'author': article.author} for article in articles]
 
+# everything the home page shows when it loads, in one go:
+# the usernames with a pending request to username, username's friends, all articles
+# and the first page of the inbox
+# the friend list comes from the in-memory friend graph, the rest is a handful of indexed queries
+def get_home_bootstrap(username: str) -> dict:
+    with get_engine().connect() as conn:
+        pending = conn.execute(
+            select(FriendRequest.from_username)
+            .where(FriendRequest.to_username == username, FriendRequest.status == 'pending')
+        ).scalars().all()
+        articles = conn.execute(
+            select(Article.id, Article.title, Article.content, Article.author)
+        ).all()
+    return {
+        "pending_requests": list(pending),
+        "friends": get_friend_graph().friends_of(username),
+        "articles": [{'id': row.id, 'title': row.title, 'content': row.content, 'author': row.author} for row in articles],
+        "inbox": get_inbox(username),
+    }
+
 # 插入新的评论到数据库
 def add_comment(article_id: int, content: str, author: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         new_comment = Comment(content=content, author=author, article_id=article_id)
         session.add(new_comment)
         session.commit()
 
 # 获取某篇文章的所有评论
 def get_comments(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comments = session.query(Comment).filter_by(article_id=article_id).all()
         return [{'id': comment.id, 'content': comment.content, 'author': comment.author, 'article_id': comment.article_id} for comment in comments]
@@ -0,0 +1,114 @@
+'''
+friend_graph
+process wide in-memory index of who is friends with whom
+
+it is loaded once from the friendship table and then kept up to date by the db
+functions that add or remove friendships, so friendship checks and friend lists
+never have to touch the database
+
+usernames are interned to small integer ids and each user's friends are kept
+as a set of those ids, every edge costs one set slot and no new objects
+'''
+
+import sys
+import threading
+from typing import Callable, Dict, Iterable, List, Set
+
+class FriendGraph():
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        # username -> id, and id -> username
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        # id -> ids of that user's friends
+        self.adjacency: Dict[int, Set[int]] = {}
+        # called with (action, username, friend_username) after a friendship is added or removed
+        self.listeners: List[Callable[[str, str, str], None]] = []
+
+    def subscribe(self, listener: Callable[[str, str, str], None]):
+        self.listeners.append(listener)
+
+    def _notify(self, action: str, username: str, friend_username: str):
+        for listener in self.listeners:
+            listener(action, username, friend_username)
+
+    # loads the graph the first time it is needed
+    # load_rows returns (username, friend_username) pairs, one per stored friendship row
+    def ensure_loaded(self, load_rows: Callable[[], Iterable]):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self.clear()
+            for username, friend_username in load_rows():
+                self._add_edge(username, friend_username)
+            self.loaded = True
+
+    def clear(self):
+        with self.lock:
+            self.ids = {}
+            self.names = []
+            self.adjacency = {}
+
+    # drops everything, the next ensure_loaded call reloads from the database
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+            self.clear()
+
+    def _id(self, username: str) -> int:
+        user_id = self.ids.get(username)
+        if user_id is None:
+            user_id = len(self.names)
+            username = sys.intern(username)
+            self.ids[username] = user_id
+            self.names.append(username)
+        return user_id
+
+    def _add_edge(self, username: str, friend_username: str):
+        user_id = self._id(username)
+        friend_id = self._id(friend_username)
+        self.adjacency.setdefault(user_id, set()).add(friend_id)
+
+    # friendships are stored in both directions, so both edges are added and removed together
+    # notify=False is used when applying a change that another process already announced
+    def add_friendship(self, username: str, friend_username: str, notify: bool = True):
+        with self.lock:
+            if self.loaded:
+                self._add_edge(username, friend_username)
+                self._add_edge(friend_username, username)
+        if notify:
+            self._notify("add", username, friend_username)
+
+    def remove_friendship(self, username: str, friend_username: str, notify: bool = True):
+        with self.lock:
+            user_id = self.ids.get(username)
+            friend_id = self.ids.get(friend_username)
+            if self.loaded and user_id is not None and friend_id is not None:
+                self.adjacency.get(user_id, set()).discard(friend_id)
+                self.adjacency.get(friend_id, set()).discard(user_id)
+        if notify:
+            self._notify("remove", username, friend_username)
+
+    def are_friends(self, username: str, friend_username: str) -> bool:
+        user_id = self.ids.get(username)
+        friend_id = self.ids.get(friend_username)
+        if user_id is None or friend_id is None:
+            return False
+        return friend_id in self.adjacency.get(user_id, ())
+
+    def friends_of(self, username: str) -> List[str]:
+        with self.lock:
+            user_id = self.ids.get(username)
+            if user_id is None:
+                return []
+            return [self.names[friend_id] for friend_id in self.adjacency.get(user_id, ())]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "users": len(self.names),
+                "edges": sum(len(friends) for friends in self.adjacency.values()),
+            }
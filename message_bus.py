@@ -0,0 +1,199 @@
+'''
+message_bus
+pub/sub between worker processes
+
+when the app runs as several worker processes each one only knows its own sockets,
+so emit(..., to=room) has to be published on a message queue that every worker listens on.
+this plugs into python-socketio's client manager interface (PubSubManager),
+and the built-in SQLite backend needs nothing but a file on local disk.
+any other python-socketio manager (redis://, kafka://, zmq+tcp://, amqp://) can be
+swapped in through the same MESSAGE_QUEUE setting
+
+the same channel also carries cache invalidations, so when one worker changes
+an in-process cache (e.g. the friend graph) the other workers hear about it.
+invalidations published while a worker wasn't listening yet (between the fork and
+the start of its listener) are never delivered to it, so when the listener starts
+the caches registered with on_resync are dropped and reloaded from the database
+
+python-socketio only starts the listener on the first socket.io connection, start()
+is called by every worker as soon as it starts instead
+'''
+
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# topic -> functions called when another process publishes an invalidation for that topic
+_handlers = {}
+# functions called when the listener starts, they drop whatever might have been invalidated meanwhile
+_resync_handlers = []
+# the manager in use, None when there is no message queue (single process)
+bus = None
+
+# registers a handler, it is called with the keyword arguments given to publish_invalidation
+def on_invalidate(topic: str, handler):
+    _handlers.setdefault(topic, []).append(handler)
+
+# registers a function that drops a cache, it is called when the listener starts
+def on_resync(handler):
+    _resync_handlers.append(handler)
+
+# starts listening in this process, instead of on the first socket.io connection
+# the listener is a thread (or greenlet), so this has to run again in every forked worker
+def start(server):
+    if bus is None or server.manager_initialized:
+        return
+    server.manager_initialized = True
+    bus.initialize()
+
+# tells the other processes that something they cache has changed
+# the calling process is expected to have updated its own cache already
+def publish_invalidation(topic: str, **data):
+    if bus is not None:
+        bus.publish_invalidation(topic, data)
+
+# adds invalidation messages to any PubSubManager
+# they travel on the same channel as the socket.io events, but are consumed here
+# instead of being passed on to the socket.io dispatcher
+class InvalidationMixin():
+    def publish_invalidation(self, topic: str, data: dict):
+        self._publish({"method": "invalidate", "topic": topic, "data": data, "host_id": self.host_id})
+
+    def _listen(self):
+        self._resync()
+        for message in super()._listen():
+            data = message
+            if isinstance(message, bytes):
+                try:
+                    data = pickle.loads(message)
+                except Exception:
+                    yield message
+                    continue
+            if isinstance(data, dict) and data.get("method") == "invalidate":
+                if data.get("host_id") != self.host_id:
+                    self._handle_invalidate(data)
+                continue
+            yield message
+
+    def _resync(self):
+        for handler in _resync_handlers:
+            try:
+                handler()
+            except Exception:
+                logger.exception("Resync handler %r failed", handler)
+
+    def _handle_invalidate(self, message: dict):
+        for handler in _handlers.get(message.get("topic"), ()):
+            try:
+                handler(**message.get("data", {}))
+            except Exception:
+                logger.exception("Invalidation handler for %s failed", message.get("topic"))
+
+# pub/sub on top of an append-only SQLite table
+# publishing is one INSERT, every listener polls for rows newer than the last one it saw
+# messages are only needed for a moment, so they are pruned after `retention` seconds
+class SQLitePubSubManager(socketio.PubSubManager):
+    name = "sqlite"
+
+    def __init__(self, url: str = "sqlite:///database/bus.db", channel: str = "flask-socketio",
+                 write_only: bool = False, logger=None, poll_interval: float = 0.005, retention: float = 60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        if not url.startswith("sqlite:///"):
+            raise ValueError(f"Expected a sqlite:/// url, got {url!r}")
+        self.path = url[len("sqlite:///"):]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.local = threading.local()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bus_messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " channel TEXT NOT NULL,"
+            " payload BLOB NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # bus messages are transient, losing the last few on a power cut doesn't matter
+        conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    # publishing can happen from any thread, each one keeps its own connection
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    def _publish(self, data):
+        self._connection().execute(
+            "INSERT INTO bus_messages (channel, payload, created) VALUES (?, ?, ?)",
+            (self.channel, pickle.dumps(data), time.time()),
+        )
+
+    def _sleep(self, seconds: float):
+        if self.server is not None:
+            self.server.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _listen(self):
+        conn = self._connect()
+        # only messages published after this process started listening are delivered
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bus_messages").fetchone()[0]
+        last_prune = time.time()
+        while True:
+            rows = conn.execute(
+                "SELECT id, payload FROM bus_messages WHERE id > ? AND channel = ? ORDER BY id",
+                (last_id, self.channel),
+            ).fetchall()
+            for message_id, payload in rows:
+                last_id = message_id
+                yield payload
+            if time.time() - last_prune > self.retention:
+                last_prune = time.time()
+                conn.execute("DELETE FROM bus_messages WHERE created < ?", (last_prune - self.retention,))
+            if not rows:
+                self._sleep(self.poll_interval)
+
+class SQLiteBusManager(InvalidationMixin, SQLitePubSubManager):
+    pass
+
+class RedisBusManager(InvalidationMixin, socketio.RedisManager):
+    pass
+
+class KafkaBusManager(InvalidationMixin, socketio.KafkaManager):
+    pass
+
+class ZmqBusManager(InvalidationMixin, socketio.ZmqManager):
+    pass
+
+class KombuBusManager(InvalidationMixin, socketio.KombuManager):
+    pass
+
+# picks the manager class from the url scheme, the same way Flask-SocketIO does for message_queue
+def make_manager(url: str, channel: str = "flask-socketio", write_only: bool = False):
+    global bus
+    if url.startswith("sqlite://"):
+        manager_class = SQLiteBusManager
+    elif url.startswith(("redis://", "rediss://")):
+        manager_class = RedisBusManager
+    elif url.startswith("kafka://"):
+        manager_class = KafkaBusManager
+    elif url.startswith("zmq"):
+        manager_class = ZmqBusManager
+    else:
+        manager_class = KombuBusManager
+    bus = manager_class(url, channel=channel, write_only=write_only)
+    return bus
@@ -0,0 +1,154 @@
+'''
+message_writer
+write-behind persistence for chat messages
+
+socket handlers put messages on a bounded queue and return straight away,
+a background thread drains the queue and commits the messages in batches,
+so a burst of chat lines costs one commit instead of one commit per line
+'''
+
+import atexit
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import blocking
+import db
+
+logger = logging.getLogger(__name__)
+
+# a batch is written once it holds MAX_BATCH rows or MAX_LATENCY seconds have passed
+# since its first row arrived, whichever happens first
+MAX_BATCH = int(os.environ.get("MESSAGE_BATCH_SIZE", 200))
+MAX_LATENCY = float(os.environ.get("MESSAGE_BATCH_LATENCY_MS", 10)) / 1000
+# enqueue blocks once this many messages are waiting, which pushes back on the senders
+MAX_QUEUE = int(os.environ.get("MESSAGE_QUEUE_SIZE", 10000))
+# a failed batch is retried this many times before it is dropped
+MAX_RETRIES = 3
+
+# marks the end of the queue when the writer is stopped
+_STOP = object()
+
+class MessageWriter():
+    def __init__(self, write_batch=None, max_batch: int = MAX_BATCH,
+                 max_latency: float = MAX_LATENCY, max_queue: int = MAX_QUEUE):
+        # write_batch takes a list of row dicts and commits them in one transaction,
+        # by default on an engine that only the writer uses (created on start)
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.last_batch_size = 0
+        # called with what write_batch returned after every committed batch,
+        # for db.insert_messages the (conversation_id, client_key, seq) of the stored messages
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if self.write_batch is None:
+                self.write_batch = functools.partial(db.insert_messages, using=db.make_writer_engine())
+            self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+
+    # queues a message to be written, the timestamp is taken now so the
+    # stored order matches the order the messages were sent in
+    # client_key makes a resent message (same sender and key) a no-op, see db.insert_messages
+    def enqueue(self, sender: str, receiver: str, message: str, client_key: str = None):
+        if self.thread is None:
+            self.start()
+        self.queue.put({
+            "sender": sender,
+            "receiver": receiver,
+            "message": message,
+            "timestamp": datetime.utcnow(),
+            "client_key": client_key,
+        })
+
+    # number of messages waiting to be written
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "last_batch_size": self.last_batch_size,
+        }
+
+    # blocks until every message queued so far has been committed
+    def flush(self):
+        self.queue.join()
+
+    # writes out whatever is still queued and stops the writer thread
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            # keep collecting until the batch is full or the latency budget is used up
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write(self, batch: list):
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                # the commit runs in a native thread under eventlet/gevent, so it can't stall the event loop
+                written = blocking.run_blocking(self.write_batch, batch)
+            except Exception:
+                logger.exception("Failed to write %d messages (attempt %d/%d)", len(batch), attempt, MAX_RETRIES)
+                time.sleep(0.05 * attempt)
+                continue
+            self.written += len(batch)
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            for listener in self.listeners:
+                try:
+                    listener(written)
+                except Exception:
+                    logger.exception("Message writer listener failed")
+            return
+        self.dropped += len(batch)
+
+writer = MessageWriter()
@@ -0,0 +1,93 @@
+'''
+migrations
+versioned schema migrations for the sqlite database
+
+Base.metadata.create_all only creates missing tables, it never changes an existing one,
+so anything that has to reach databases that already exist (indexes, new columns, backfills)
+goes in a numbered migration module in this package, e.g. m0001_message_indexes.py.
+each module defines an upgrade(conn) function that runs inside its own transaction,
+and the schema_version table records which migrations have already been applied
+
+to upgrade a database in place run
+    python -m migrations upgrade
+'''
+
+import importlib
+import pkgutil
+import re
+
+from sqlalchemy import text
+
+# migration modules are named m<4 digit version>_<description>
+MIGRATION_NAME = re.compile(r"^m(\d{4})_\w+$")
+
+def discover() -> list:
+    # returns (version, name, module) for every migration, sorted by version
+    found = []
+    for module_info in pkgutil.iter_modules(__path__):
+        match = MIGRATION_NAME.match(module_info.name)
+        if match is None:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        found.append((int(match.group(1)), module_info.name, module))
+    found.sort(key=lambda migration: migration[0])
+    versions = [version for version, _, _ in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions in {versions}")
+    return found
+
+def ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version INTEGER PRIMARY KEY,"
+        " name TEXT NOT NULL,"
+        " applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    ))
+
+def applied_versions(conn) -> set:
+    ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+def current_version(engine) -> int:
+    with engine.begin() as conn:
+        return max(applied_versions(conn), default=0)
+
+# applies every migration that hasn't run yet, returns the list of versions applied
+def upgrade(engine, target: int = None) -> list:
+    applied = []
+    for version, name, module in discover():
+        if target is not None and version > target:
+            break
+        # each migration gets its own transaction, so a failure leaves
+        # the database at the last migration that succeeded
+        with engine.begin() as conn:
+            # pysqlite only opens a transaction before the first INSERT/UPDATE/DELETE, so the
+            # check and any DDL would run outside of it. BEGIN IMMEDIATE takes the write lock
+            # up front, a second process waits here (busy_timeout) until this one commits
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            # re-checked inside the transaction in case another process got here first
+            if version in applied_versions(conn):
+                continue
+            module.upgrade(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name},
+            )
+        applied.append(version)
+    if applied:
+        # refresh the query planner statistics so the new indexes get used
+        # optimize may write (ANALYZE), so it takes the write lock up front as well
+        with engine.begin() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            conn.execute(text("PRAGMA optimize"))
+    return applied
+
+def table_exists(conn, table: str) -> bool:
+    row = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": table},
+    ).first()
+    return row is not None
+
+def column_exists(conn, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(text(f"PRAGMA table_info({table})")))
@@ -0,0 +1,38 @@
+'''
+command line entry point for the migration runner
+
+    python -m migrations upgrade [--target VERSION]
+    python -m migrations status
+
+the database is picked the same way as the app picks it, through DB_PROFILE
+'''
+
+import argparse
+
+import migrations
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m migrations")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    upgrade_parser = subcommands.add_parser("upgrade", help="apply all pending migrations")
+    upgrade_parser.add_argument("--target", type=int, default=None, help="stop after this version")
+    subcommands.add_parser("status", help="show applied and pending migrations")
+    args = parser.parse_args()
+
+    # opening the engine creates the tables and already applies pending migrations,
+    # so `upgrade` mostly matters for --target and for reporting
+    import db
+
+    if args.command == "upgrade":
+        applied = migrations.upgrade(db.engine, target=args.target)
+        if applied:
+            print(f"Applied migrations: {', '.join(map(str, applied))}")
+        print(f"Database is at version {migrations.current_version(db.engine)}")
+    else:
+        current = migrations.current_version(db.engine)
+        for version, name, _ in migrations.discover():
+            state = "applied" if version <= current else "pending"
+            print(f"{version:04d} {name} [{state}]")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+'''
+indexes for message history lookups
+receiver + timestamp serves "all messages received by a user" in time order,
+sender + receiver + id serves paging through a single conversation
+'''
+
+from sqlalchemy import text
+
+def upgrade(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_receiver_timestamp ON messages (receiver, timestamp)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_sender_receiver_id ON messages (sender, receiver, id)"))
@@ -0,0 +1,8 @@
+'''
+index for the pending friend request lookup, which filters on to_username and status
+'''
+
+from sqlalchemy import text
+
+def upgrade(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_friend_request_to_status ON friend_request (to_username, status)"))
@@ -0,0 +1,8 @@
+'''
+index for loading the comments of an article in insertion order
+'''
+
+from sqlalchemy import text
+
+def upgrade(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_article_id ON comments (article_id, id)"))
@@ -0,0 +1,36 @@
+'''
+per-conversation sequence numbers and idempotency keys for messages
+conversation_id is the same id as the conversation's socket.io room (models.conversation_id),
+seq counts the messages of a conversation from 1 upwards, and client_key is the key the
+sending client attached, so a message sent twice is only stored once
+existing messages are numbered in id order
+'''
+
+from sqlalchemy import text
+
+from migrations import column_exists
+from models import conversation_id
+
+def upgrade(conn):
+    for column, type_ in (("conversation_id", "BIGINT"), ("seq", "INTEGER"), ("client_key", "VARCHAR")):
+        if not column_exists(conn, "messages", column):
+            conn.execute(text(f"ALTER TABLE messages ADD COLUMN {column} {type_}"))
+
+    pairs = conn.execute(text("SELECT DISTINCT sender, receiver FROM messages WHERE conversation_id IS NULL")).all()
+    for sender, receiver in pairs:
+        conn.execute(
+            text("UPDATE messages SET conversation_id = :cid WHERE sender = :sender AND receiver = :receiver"),
+            {"cid": conversation_id(sender, receiver), "sender": sender, "receiver": receiver},
+        )
+
+    conn.execute(text("CREATE TEMP TABLE message_seq (id INTEGER PRIMARY KEY, seq INTEGER NOT NULL)"))
+    conn.execute(text(
+        "INSERT INTO message_seq (id, seq) "
+        "SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY id) FROM messages"
+    ))
+    conn.execute(text("UPDATE messages SET seq = (SELECT seq FROM message_seq WHERE message_seq.id = messages.id)"))
+    conn.execute(text("DROP TABLE message_seq"))
+
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_conversation_seq ON messages (conversation_id, seq)"))
+    # sqlite treats NULLs as distinct, so messages without a key never collide
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_sender_client_key ON messages (sender, client_key)"))
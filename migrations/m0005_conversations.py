@@ -0,0 +1,23 @@
+'''
+inbox indexes on the conversation table, and one conversation row for every pair
+of users that already has messages (last message filled in, nothing unread)
+the table itself is created by create_all, see models.Conversation
+'''
+
+from sqlalchemy import text
+
+def upgrade(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_conversation_user_a_last ON conversation (user_a, last_message_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_conversation_user_b_last ON conversation (user_b, last_message_id)"))
+
+    conn.execute(text(
+        "INSERT OR IGNORE INTO conversation (id, user_a, user_b, last_seq, unread_a, unread_b) "
+        "SELECT DISTINCT conversation_id, min(sender, receiver), max(sender, receiver), 0, 0, 0 "
+        "FROM messages WHERE conversation_id IS NOT NULL"
+    ))
+    conn.execute(text(
+        "UPDATE conversation SET (last_message_id, last_seq, last_sender, last_preview, last_timestamp) = ("
+        "SELECT id, seq, sender, substr(message, 1, 100), timestamp FROM messages "
+        "WHERE messages.conversation_id = conversation.id ORDER BY seq DESC LIMIT 1"
+        ") WHERE last_message_id IS NULL"
+    ))
@@ -0,0 +1,14 @@
+'''
+indexes for the message archive
+messages(timestamp) finds the messages old enough to be archived without a table scan,
+archive_blocks(conversation_id, first_id) / (conversation_id, last_seq) find the blocks
+a history page or a sync needs
+the archive_blocks table itself is created by create_all, see models.ArchiveBlock
+'''
+
+from sqlalchemy import text
+
+def upgrade(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_timestamp ON messages (timestamp)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_archive_blocks_conversation_id ON archive_blocks (conversation_id, first_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_archive_blocks_conversation_seq ON archive_blocks (conversation_id, last_seq)"))
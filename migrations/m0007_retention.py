@@ -0,0 +1,17 @@
+'''
+friend_request.updated_at for the retention sweeper, and the indexes it deletes by
+existing requests get the time of the upgrade, so accepted ones are kept for the full
+retention period from then on
+the other retention indexes are messages(timestamp) from m0006 and sessions(expires_at)
+'''
+
+from sqlalchemy import text
+
+from migrations import column_exists
+
+def upgrade(conn):
+    if not column_exists(conn, "friend_request", "updated_at"):
+        conn.execute(text("ALTER TABLE friend_request ADD COLUMN updated_at DATETIME"))
+    conn.execute(text("UPDATE friend_request SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_friend_request_status_updated ON friend_request (status, updated_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_archive_blocks_last_timestamp ON archive_blocks (last_timestamp)"))
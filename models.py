@@ -1,7 +1,7 @@
 '''
 models
 defines sql alchemy data models
-also contains the definition for the room class used to keep track of socket.io rooms
+also contains the definition for the room registry used to keep track of socket.io rooms
 
 Just a sidenote, using SQLAlchemy is a pain. If you want to go above and beyond, 
 do this whole project in Node.js + Express and use Prisma instead, 
@@ -10,10 +10,13 @@ Prisma docs also looks so much better in comparison
 or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attacks :) )
 '''
 
-from sqlalchemy import String, Column, ForeignKey, Table, Integer, DateTime, Text
+from sqlalchemy import String, Column, ForeignKey, Table, Integer, BigInteger, DateTime, Text, LargeBinary
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from typing import Dict
+from typing import Dict, Set
 from datetime import datetime
+import hashlib
+import sys
+import threading
 
 # data models
 class Base(DeclarativeBase):
@@ -33,13 +36,19 @@ user_friend_table = Table(
     Column('friend_username', String, ForeignKey('user.username'), primary_key=True)
 )
 
+# relationships are only there for writing and for explicit queries
+# collections are write_only and many-to-one sides raise on lazy loads,
+# so no code path can hydrate a whole friend list by accident
 class FriendRequest(Base):
     __tablename__ = 'friend_request'
     from_username = Column(String, ForeignKey('user.username'), primary_key=True)
     to_username = Column(String, ForeignKey('user.username'), primary_key=True)
     status = Column(String, default='pending') 
-    from_user = relationship("User", foreign_keys=[from_username])
-    to_user = relationship("User", foreign_keys=[to_username])
+    # when the request was sent or, once accepted, when it was accepted
+    # accepted requests are deleted some time after that, see retention.py
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    from_user = relationship("User", foreign_keys=[from_username], lazy="raise_on_sql")
+    to_user = relationship("User", foreign_keys=[to_username], lazy="raise_on_sql")
 
     def __repr__(self):
         return f"<FriendRequest(from={self.from_username}, to={self.to_username})>"
@@ -59,17 +68,20 @@ class User(Base):
         secondary=user_friend_table,
         primaryjoin=username == user_friend_table.c.user_username,
         secondaryjoin=username == user_friend_table.c.friend_username,
-        back_populates='friends'
+        back_populates='friends',
+        lazy="write_only"
     )
     pending_requests_sent = relationship(
         "FriendRequest",
         foreign_keys="FriendRequest.from_username",
-        back_populates="from_user"
+        back_populates="from_user",
+        lazy="write_only"
     )   
     pending_requests_received = relationship(
         "FriendRequest",
         foreign_keys="FriendRequest.to_username",
-        back_populates="to_user"
+        back_populates="to_user",
+        lazy="write_only"
     )
     
     def __repr__(self):
@@ -83,63 +95,224 @@ class Message(Base):
     receiver = Column(String, ForeignKey('user.username'), nullable=False)
     message = Column(String, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # the conversation (same id as its room) and the message's position in it, counting from 1
+    # see db.insert_messages and migrations/m0004_message_sequence.py
+    conversation_id = Column(BigInteger)
+    seq = Column(Integer)
+    # key the sending client gave the message, a resent message with the same key is ignored
+    client_key = Column(String)
 
-    sender_user = relationship('User', foreign_keys=[sender])
-    receiver_user = relationship('User', foreign_keys=[receiver])
+    sender_user = relationship('User', foreign_keys=[sender], lazy="raise_on_sql")
+    receiver_user = relationship('User', foreign_keys=[receiver], lazy="raise_on_sql")
 
     def __repr__(self):
         return f"<Message(sender={self.sender}, receiver={self.receiver}, message={self.message}, timestamp={self.timestamp})>"
 
-# stateful counter used to generate the room id
-class Counter():
-    def __init__(self):
-        self.counter = 0
-    
-    def get(self):
-        self.counter += 1
-        return self.counter
+# one row per pair of users who have exchanged messages, kept up to date by db.insert_messages
+# in the same transaction as the messages, so the inbox never has to scan the messages table
+# id is conversation_id(user_a, user_b) and user_a sorts before user_b,
+# unread_a / unread_b count the messages the respective user hasn't read yet
+class Conversation(Base):
+    __tablename__ = 'conversation'
+
+    id = Column(BigInteger, primary_key=True)
+    user_a = Column(String, ForeignKey('user.username'), nullable=False)
+    user_b = Column(String, ForeignKey('user.username'), nullable=False)
+    last_message_id = Column(Integer)
+    last_seq = Column(Integer, nullable=False, default=0)
+    last_sender = Column(String)
+    last_preview = Column(String)
+    last_timestamp = Column(DateTime)
+    unread_a = Column(Integer, nullable=False, default=0)
+    unread_b = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<Conversation(user_a={self.user_a}, user_b={self.user_b}, last_message_id={self.last_message_id})>"
+
+# block index of the message archive, see archive.py
+# one row per compressed block of a segment file, a block holds consecutive messages
+# (by seq, and so by id) of a single conversation
+# offset and length locate the block in the segment, so reading it is one seek and one read
+class ArchiveBlock(Base):
+    __tablename__ = 'archive_blocks'
+
+    id = Column(Integer, primary_key=True)
+    segment = Column(String, nullable=False)
+    conversation_id = Column(BigInteger, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    first_seq = Column(Integer, nullable=False)
+    last_seq = Column(Integer, nullable=False)
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    count = Column(Integer, nullable=False)
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
 
-# Room class, used to keep track of which username is in which room
-class Room():
+    def __repr__(self):
+        return f"<ArchiveBlock(segment={self.segment}, conversation_id={self.conversation_id}, seq={self.first_seq}..{self.last_seq})>"
+
+# server side sessions, see session_store.py
+# id is the md5 of the session's store id (the same name the old session files used),
+# so the table never holds a usable session id
+# expires_at is indexed for the expiry sweep
+class SessionRecord(Base):
+    __tablename__ = 'sessions'
+
+    id = Column(String(32), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SessionRecord(id={self.id}, expires_at={self.expires_at})>"
+
+# the room id of a conversation is derived from the two usernames,
+# so every process (and every restart) computes the same id for the same pair
+# and a room_id cookie sent back by a reconnecting client is still valid
+# it is cut to 52 bits so it stays an exact integer in JavaScript
+def conversation_id(user_a: str, user_b: str) -> int:
+    first, second = sorted((user_a, user_b))
+    digest = hashlib.sha1(f"{first}\0{second}".encode("utf-8")).hexdigest()
+    return int(digest[:13], 16)
+
+# Room registry, used to keep track of which users and sockets are in which room
+# every mapping is kept in both directions so all lookups are dictionary hits,
+# nothing here scans over every online user
+# a user can have several sockets (browser tabs) and be in several rooms,
+# and a room is dropped as soon as its last socket disconnects or leaves
+class RoomRegistry():
     def __init__(self):
-        self.counter = Counter()
-        # dictionary that maps the username to the room id
-        # for example self.dict["John"] -> gives you the room id of 
-        # the room where John is in
-        self.dict: Dict[str, int] = {}
-
-    def create_room(self, sender: str, receiver: str) -> int:
-        room_id = self.counter.get()
-        self.dict[sender] = room_id
-        self.dict[receiver] = room_id
-        return room_id
-    
-    def join_room(self,  sender: str, room_id: int) -> int:
-        self.dict[sender] = room_id
+        # RLock is swapped for a green lock when eventlet/gevent monkey patch threading
+        self.lock = threading.RLock()
+        # room id -> usernames taking part in the room, including a receiver who hasn't joined yet
+        self.room_users: Dict[int, Set[str]] = {}
+        # username -> room ids the user takes part in
+        self.user_rooms: Dict[str, Set[int]] = {}
+        # room id -> socket ids connected to the room, and the reverse
+        self.room_sids: Dict[int, Set[str]] = {}
+        self.sid_rooms: Dict[str, Set[int]] = {}
+        # socket id -> username
+        self.sid_user: Dict[str, str] = {}
 
-    def leave_room(self, user):
-        if user not in self.dict.keys():
+    # room ids come from conversation_id, so creating a room that is already
+    # active simply joins it
+    def create_room(self, sender: str, receiver: str, sid: str = None) -> int:
+        with self.lock:
+            room_id = conversation_id(sender, receiver)
+            self._add_user(receiver, room_id)
+            self.join_room(sender, room_id, sid)
+            return room_id
+
+    def join_room(self, sender: str, room_id: int, sid: str = None):
+        with self.lock:
+            self._add_user(sender, room_id)
+            if sid is not None:
+                self.room_sids.setdefault(room_id, set()).add(sid)
+                self.sid_rooms.setdefault(sid, set()).add(room_id)
+                self.sid_user[sid] = sender
+
+    def _add_user(self, user: str, room_id: int):
+        self.room_users.setdefault(room_id, set()).add(user)
+        self.user_rooms.setdefault(user, set()).add(room_id)
+
+    # removes a user (and all of the user's sockets) from one room, or from every room
+    def leave_room(self, user: str, room_id: int = None):
+        with self.lock:
+            rooms = [room_id] if room_id is not None else list(self.user_rooms.get(user, ()))
+            for room in rooms:
+                for sid in [sid for sid in self.room_sids.get(room, ()) if self.sid_user.get(sid) == user]:
+                    self._remove_sid(sid, room)
+                self._discard(self.room_users, room, user)
+                self._discard(self.user_rooms, user, room)
+                self._drop_room_if_empty(room)
+
+    # called when a socket disconnects, returns the rooms the socket was in
+    # the user stays a participant (like a receiver who hasn't joined yet),
+    # the room itself goes away once its last socket is gone
+    def disconnect(self, sid: str) -> Set[int]:
+        with self.lock:
+            rooms = self.sid_rooms.get(sid, set()).copy()
+            for room in rooms:
+                self._remove_sid(sid, room)
+                self._drop_room_if_empty(room)
+            self.sid_rooms.pop(sid, None)
+            self.sid_user.pop(sid, None)
+            return rooms
+
+    def _remove_sid(self, sid: str, room_id: int):
+        self._discard(self.room_sids, room_id, sid)
+        self._discard(self.sid_rooms, sid, room_id)
+        if sid not in self.sid_rooms:
+            self.sid_user.pop(sid, None)
+
+    # a room without any connected socket is forgotten, the next join creates a new one
+    def _drop_room_if_empty(self, room_id: int):
+        if self.room_sids.get(room_id):
             return
-        del self.dict[user]
+        self.room_sids.pop(room_id, None)
+        for user in self.room_users.pop(room_id, set()):
+            self._discard(self.user_rooms, user, room_id)
+
+    @staticmethod
+    def _discard(index: dict, key, value):
+        values = index.get(key)
+        if values is None:
+            return
+        values.discard(value)
+        if not values:
+            del index[key]
+
+    # the readers take the lock too, copying or iterating a set while another
+    # thread changes it raises "Set changed size during iteration"
+    # gets the id of the room shared by sender and receiver, if it is currently active
+    def get_room_id(self, sender: str, receiver: str):
+        room_id = conversation_id(sender, receiver)
+        with self.lock:
+            return room_id if room_id in self.room_users else None
+
+    def get_rooms(self, user: str) -> Set[int]:
+        with self.lock:
+            return set(self.user_rooms.get(user, ()))
+
+    def get_members(self, room_id: int) -> Set[str]:
+        with self.lock:
+            return set(self.room_users.get(room_id, ()))
 
-    # gets the room id from a user
-    def get_room_id(self, user: str):
-        if user not in self.dict.keys():
-            return None
-        return self.dict[user]
-    
     def get_receiver_in_room(self, sender, room_id):
-        for user, room in self.dict.items():
-            if room == room_id and user != sender:
-                return user
-        return None
+        with self.lock:
+            for user in self.room_users.get(room_id, ()):
+                if user != sender:
+                    return user
+            return None
+
+    # sizes of the indexes and a rough estimate of the memory they use
+    def stats(self) -> dict:
+        with self.lock:
+            indexes = {
+                "room_users": self.room_users,
+                "user_rooms": self.user_rooms,
+                "room_sids": self.room_sids,
+                "sid_rooms": self.sid_rooms,
+                "sid_user": self.sid_user,
+            }
+            size = 0
+            for index in indexes.values():
+                size += sys.getsizeof(index)
+                for value in index.values():
+                    size += sys.getsizeof(value)
+            return {
+                "rooms": len(self.room_users),
+                "users": len(self.user_rooms),
+                "sockets": len(self.sid_user),
+                "approx_bytes": size,
+            }
 class Article(Base):
     __tablename__ = 'articles'
     id = Column(Integer, primary_key=True)
     title = Column(String(100), nullable=False)
     content = Column(Text, nullable=False)
     author = Column(String(50), nullable=False)
-    comments = relationship("Comment", back_populates="article")
+    comments = relationship("Comment", back_populates="article", lazy="write_only")
 
 class Comment(Base):
     __tablename__ = 'comments'
@@ -147,4 +320,4 @@ class Comment(Base):
     content = Column(Text, nullable=False)
     author = Column(String(50), nullable=False)
     article_id = Column(Integer, ForeignKey('articles.id'))
-    article = relationship("Article", back_populates="comments")
\ No newline at end of file
+    article = relationship("Article", back_populates="comments", lazy="raise_on_sql")
\ No newline at end of file
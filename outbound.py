@@ -0,0 +1,241 @@
+'''
+outbound
+coalescing and backpressure for outgoing socket.io events
+
+every emit normally becomes its own websocket frame, so a busy room sends a stream of
+tiny frames (and a syscall for each). here the chat events for a connection are held for
+a short window (OUTBOUND_COALESCE_MS) and everything that piled up goes out as one
+"batch" event, which the client in home.jinja unpacks into the original events
+
+only plain events without an ack are held back. any other packet for the same
+connection (an ack, history, a disconnect) first flushes what is waiting, so the
+client still sees everything in the order it was sent
+
+a connection whose engine.io queue already holds OUTBOUND_QUEUE_SIZE packets is a slow
+reader, its chat events stay here instead (at most OUTBOUND_PENDING_SIZE of them) until it
+catches up. when that is full too, SLOW_CONSUMER_POLICY decides what happens:
+    drop_oldest  the oldest waiting event is dropped
+    disconnect   the connection is closed, the client reconnects and reloads its history
+    summary      the waiting events are replaced by one "skipped" event saying how many chat
+                 messages were missed, the client then syncs them (see home.jinja)
+
+installed on the python-socketio server by create_app() in app.py, with
+OUTBOUND_COALESCE_MS=0 events are only held back for slow readers
+'''
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from socketio import packet
+
+logger = logging.getLogger(__name__)
+
+# how long the first event of a batch may wait for company
+WINDOW = float(os.environ.get("OUTBOUND_COALESCE_MS", 10)) / 1000
+# events that may be held back and batched, everything else is sent straight away
+# "seq" follows every committed batch of chat messages (see socket_routes.py), if it wasn't
+# held back too it would flush the waiting chat events, even those of slow readers
+COALESCED_EVENTS = {"incoming", "seq"}
+# name of the event that carries a batch, its only argument is a list of [event, *args]
+BATCH_EVENT = "batch"
+# name of the event that replaces what the summary policy drops, its argument is the number of chat messages
+SKIPPED_EVENT = "skipped"
+# engine.io packets waiting to be written before a connection counts as slow
+MAX_QUEUE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", 100))
+# chat events kept for a slow connection before the policy applies
+MAX_PENDING = int(os.environ.get("OUTBOUND_PENDING_SIZE", 200))
+POLICIES = ("drop_oldest", "disconnect", "summary")
+POLICY = os.environ.get("SLOW_CONSUMER_POLICY", "drop_oldest")
+if POLICY not in POLICIES:
+    raise ValueError(f"Unknown SLOW_CONSUMER_POLICY {POLICY!r}, expected one of {POLICIES}")
+# how often a slow connection is checked again
+MIN_RETRY = 0.05
+
+# chat events waiting for one connection
+class _Buffer():
+    __slots__ = ("namespace", "entries", "skipped")
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        # (time queued, [event, *args])
+        self.entries = deque()
+        # chat messages replaced by the summary event
+        self.skipped = 0
+
+class OutboundCoalescer():
+    def __init__(self, window: float = WINDOW, events=COALESCED_EVENTS, max_queue: int = MAX_QUEUE,
+                 max_pending: int = MAX_PENDING, policy: str = POLICY):
+        self.window = window
+        self.retry = max(window, MIN_RETRY)
+        self.events = set(events)
+        self.max_queue = max_queue
+        self.max_pending = max_pending
+        self.policy = policy
+        self.server = None
+        self._send = None
+        self.condition = threading.Condition()
+        # engine.io sid -> buffer
+        self.buffers = {}
+        # (deadline, engine.io sid, buffer) in deadline order
+        # entries whose buffer has been flushed in the meantime are skipped
+        self.deadlines = deque()
+        self.thread = None
+        self.thread_pid = None
+        # metrics
+        self.events_coalesced = 0
+        self.frames_sent = 0
+        self.added_latency = 0.0
+        self.max_added_latency = 0.0
+        self.deferred = 0
+        self.dropped = 0
+        self.summarized = 0
+        self.disconnected = 0
+
+    # takes over the server's packet sending
+    def install(self, server):
+        self.server = server
+        self._send = server._send_packet
+        server._send_packet = self.send_packet
+
+    def _coalescible(self, pkt) -> bool:
+        return (
+            pkt.packet_type == packet.EVENT
+            and pkt.id is None
+            and isinstance(pkt.data, list)
+            and pkt.data[0] in self.events
+            and not pkt._data_is_binary(pkt.data)
+        )
+
+    # True when the connection's engine.io queue is too long, i.e. the client reads too slowly
+    def _backlogged(self, eio_sid) -> bool:
+        socket = self.server.eio.sockets.get(eio_sid)
+        return socket is not None and socket.queue.qsize() >= self.max_queue
+
+    def send_packet(self, eio_sid, pkt):
+        if not self._coalescible(pkt):
+            self.flush(eio_sid)
+            self._send(eio_sid, pkt)
+            return
+        self._start()
+        disconnect = False
+        with self.condition:
+            buffer = self.buffers.get(eio_sid)
+            if buffer is None:
+                if self.window <= 0 and not self._backlogged(eio_sid):
+                    self._send(eio_sid, pkt)
+                    return
+                buffer = self.buffers[eio_sid] = _Buffer(pkt.namespace)
+                self.deadlines.append((time.monotonic() + (self.window or self.retry), eio_sid, buffer))
+                self.condition.notify()
+            elif buffer.namespace != pkt.namespace:
+                # batches never mix namespaces
+                self._flush_locked(eio_sid, force=True)
+                self.send_packet(eio_sid, pkt)
+                return
+            buffer.entries.append((time.monotonic(), pkt.data))
+            if len(buffer.entries) > self.max_pending:
+                disconnect = self._overflow(eio_sid, buffer)
+        if disconnect:
+            self.server.eio.disconnect(eio_sid)
+
+    # applies the slow consumer policy to a full buffer, returns True if the connection has to be closed
+    def _overflow(self, eio_sid, buffer) -> bool:
+        if self.policy == "drop_oldest":
+            buffer.entries.popleft()
+            self.dropped += 1
+            return False
+        if self.policy == "summary":
+            # the notice counts chat messages, not the seq events that follow them
+            buffer.skipped += sum(1 for _, data in buffer.entries if data[0] == "incoming")
+            self.summarized += len(buffer.entries)
+            buffer.entries.clear()
+            return False
+        del self.buffers[eio_sid]
+        self.disconnected += 1
+        return True
+
+    # sends whatever is waiting for one connection, even if it is slow
+    def flush(self, eio_sid):
+        if eio_sid not in self.buffers:
+            return
+        with self.condition:
+            self._flush_locked(eio_sid, force=True)
+
+    def _flush_locked(self, eio_sid, force: bool = False):
+        buffer = self.buffers.get(eio_sid)
+        if buffer is None:
+            return
+        if not force and self._backlogged(eio_sid):
+            # the client hasn't caught up yet, look again later
+            self.deferred += 1
+            self.deadlines.append((time.monotonic() + self.retry, eio_sid, buffer))
+            return
+        del self.buffers[eio_sid]
+        events = [data for _, data in buffer.entries]
+        if buffer.skipped:
+            events.insert(0, [SKIPPED_EVENT, buffer.skipped])
+        if not events:
+            return
+        now = time.monotonic()
+        for queued_at, _ in buffer.entries:
+            waited = now - queued_at
+            self.added_latency += waited
+            self.max_added_latency = max(self.max_added_latency, waited)
+        self.events_coalesced += len(buffer.entries)
+        self.frames_sent += 1
+        if len(events) == 1:
+            pkt = self.server.packet_class(packet.EVENT, namespace=buffer.namespace, data=events[0])
+        else:
+            pkt = self.server.packet_class(packet.EVENT, namespace=buffer.namespace, data=[BATCH_EVENT, events])
+        try:
+            self._send(eio_sid, pkt)
+        except Exception:
+            logger.exception("Failed to send a batch to %s", eio_sid)
+
+    # the flusher thread is started on first use in every process, threads don't survive a fork
+    def _start(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.condition:
+            if self.thread_pid == os.getpid():
+                return
+            self.buffers.clear()
+            self.deadlines.clear()
+            self.thread_pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="outbound-coalescer", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.deadlines:
+                    self.condition.wait()
+                deadline, eio_sid, buffer = self.deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self.deadlines.popleft()
+                if self.buffers.get(eio_sid) is buffer:
+                    self._flush_locked(eio_sid)
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window * 1000,
+            "events_coalesced": self.events_coalesced,
+            "frames_sent": self.frames_sent,
+            "frames_saved": self.events_coalesced - self.frames_sent,
+            "avg_added_latency_ms": round(self.added_latency / self.events_coalesced * 1000, 2) if self.events_coalesced else 0.0,
+            "max_added_latency_ms": round(self.max_added_latency * 1000, 2),
+            "pending_connections": len(self.buffers),
+            "slow_consumer_policy": self.policy,
+            "deferred": self.deferred,
+            "dropped": self.dropped,
+            "summarized": self.summarized,
+            "disconnected": self.disconnected,
+        }
+
+coalescer = OutboundCoalescer()
@@ -0,0 +1,156 @@
+'''
+passwords
+password hashing on a bounded pool of worker processes
+
+bcrypt is slow on purpose (a few hundred ms of CPU per call), run on the request thread
+it holds the GIL long enough that a burst of logins freezes chat delivery in the same worker.
+the hashing runs in separate processes instead (in native threads under eventlet/gevent,
+see PasswordHasher._run), and once too many hashes are waiting new logins are turned away
+straight away rather than queueing up behind them
+
+the work factor (bcrypt rounds) is calibrated once so one hash takes about BCRYPT_TARGET_MS
+on this machine and kept in BCRYPT_ROUNDS_FILE, so timing noise at startup can't change it
+between deploys (delete the file to calibrate again), unless BCRYPT_ROUNDS pins it.
+stored hashes made with a lower work factor are replaced the next time their owner logs in
+'''
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import bcrypt
+
+import blocking
+
+# number of hashing processes
+POOL_SIZE = int(os.environ.get("PASSWORD_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# hashes allowed to be running or waiting at once, anything beyond that is rejected
+MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", POOL_SIZE * 4))
+# how long one hash should take, used to pick the work factor
+TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", 250))
+# bounds for the calibrated work factor, 12 is the bcrypt default
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+DEFAULT_ROUNDS = 12
+# where the calibrated work factor is kept
+ROUNDS_FILE = os.environ.get("BCRYPT_ROUNDS_FILE", "database/bcrypt_rounds.json")
+
+# "$2b$12$..." -> 12
+HASH_ROUNDS = re.compile(r"^\$2[abxy]?\$(\d{2})\$")
+
+class PasswordPoolBusy(Exception):
+    pass
+
+# these two run inside the pool processes
+def _hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+def _check(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+def hash_rounds(hashed: str):
+    match = HASH_ROUNDS.match(hashed or "")
+    return int(match.group(1)) if match else None
+
+# picks the largest work factor whose hash still takes at most target_ms
+# every extra round doubles the cost, so the time of one round count predicts the next
+def calibrate(target_ms: float = TARGET_MS) -> int:
+    rounds = MIN_ROUNDS
+    while rounds < MAX_ROUNDS:
+        start = time.perf_counter()
+        _hash("calibration", rounds)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms * 2 > target_ms:
+            break
+        rounds += 1
+    return rounds
+
+class PasswordHasher():
+    def __init__(self, pool_size: int = POOL_SIZE, max_pending: int = MAX_PENDING, rounds: int = None):
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+        self.rounds = rounds or DEFAULT_ROUNDS
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        # the pool belongs to the process that created it, a forked worker makes its own
+        self.executor_pid = None
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    # uses the work factor stored in path, calibrating and storing it first if there is none
+    # the file is locked meanwhile, so workers starting together agree on the value
+    def calibrate(self, target_ms: float = TARGET_MS, path: str = ROUNDS_FILE) -> int:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as rounds_file:
+                    self.rounds = int(json.load(rounds_file)["rounds"])
+            except (FileNotFoundError, ValueError, KeyError, TypeError):
+                self.rounds = calibrate(target_ms)
+                tmp_path = path.with_suffix(".tmp")
+                with open(tmp_path, "w") as rounds_file:
+                    json.dump({"rounds": self.rounds, "target_ms": target_ms, "calibrated": time.time()}, rounds_file)
+                    rounds_file.flush()
+                    os.fsync(rounds_file.fileno())
+                os.replace(tmp_path, path)
+        return self.rounds
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.pool_size)
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    # runs fn in the pool and waits for it, raises PasswordPoolBusy when the pool is full
+    # under eventlet/gevent the process pool can't be used, its futures and management thread
+    # are built on the patched (green) threading module and waiting on them from a native
+    # thread hangs. bcrypt releases the GIL while it hashes, so there it runs in the hub's
+    # native thread pool instead, and the slots are taken and given back on the green side
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        if blocking.GREEN:
+            try:
+                return blocking.run_blocking(fn, *args)
+            finally:
+                self.slots.release()
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, password: str, hashed: str) -> bool:
+        return self._run(_check, password, hashed)
+
+    # true when the stored hash was made with a lower work factor than the current one
+    # a higher one is kept, lowering BCRYPT_ROUNDS doesn't make every login hash twice
+    def needs_rehash(self, hashed: str) -> bool:
+        rounds = hash_rounds(hashed)
+        return rounds is None or rounds < self.rounds
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None and self.executor_pid == os.getpid():
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+hasher = PasswordHasher(rounds=int(os.environ["BCRYPT_ROUNDS"]) if os.environ.get("BCRYPT_ROUNDS") else None)
@@ -0,0 +1,301 @@
+'''
+retention
+background deletion of data that is past its retention period
+
+one big DELETE would hold sqlite's write lock for as long as it runs and every chat
+message written meanwhile would wait for it, so each policy deletes its rows in batches
+of RETENTION_BATCH (oldest first, one short transaction each), sleeps between batches,
+and waits while the message writer has messages queued. after a sweep that deleted anything
+the WAL is checkpointed, so the log doesn't grow by everything that was deleted
+
+the policies, each can be turned off with "off":
+    RETENTION_MESSAGES_DAYS         messages older than this, archived ones included (default off)
+    RETENTION_FRIEND_REQUESTS_DAYS  accepted friend requests, counted from the acceptance (default 30),
+                                    the friendship itself is kept in user_friend
+    RETENTION_SESSIONS_DAYS         sessions that expired this long ago (default 0, as soon as they expire)
+
+every worker sweeps in a background thread every RETENTION_INTERVAL seconds (0 turns it off).
+under eventlet/gevent the batches and checkpoints run in a native thread (see blocking.run_blocking)
+while the waits between them stay on the event loop.
+RETENTION_DRY_RUN=1 only counts what would be deleted. to see what a sweep would do, or to run one by hand
+    python3 retention.py [--dry-run]
+'''
+
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, literal_column, select, update
+
+import archive
+import blocking
+from models import Conversation, FriendRequest, Message, SessionRecord
+
+logger = logging.getLogger(__name__)
+
+# rows deleted per transaction
+BATCH = int(os.environ.get("RETENTION_BATCH", 500))
+# pause after every batch
+PAUSE = float(os.environ.get("RETENTION_PAUSE_MS", 50)) / 1000
+# seconds between sweeps
+INTERVAL = float(os.environ.get("RETENTION_INTERVAL", 3600))
+DRY_RUN = os.environ.get("RETENTION_DRY_RUN", "") not in ("", "0", "false")
+# the WAL is also checkpointed every this many batches during a long sweep
+CHECKPOINT_EVERY = 100
+# a progress line is logged every this many batches
+PROGRESS_EVERY = 20
+# longest wait for the message writer before a batch runs anyway
+MAX_YIELD = 1.0
+
+def _days(name: str, default):
+    value = os.environ.get(name, default)
+    if value is None or str(value).lower() in ("", "off"):
+        return None
+    return timedelta(days=float(value))
+
+# rows of table whose age_column is older than max_age (and that match where) are deleted, oldest first
+# the batches are keyed on the rowid, which every table here has
+class Policy():
+    def __init__(self, name: str, table, age_column, max_age: timedelta, where=()):
+        self.name = name
+        self.table = table
+        self.age_column = age_column
+        self.max_age = max_age
+        self.where = tuple(where)
+
+    def cutoff(self, now: datetime) -> datetime:
+        return now - self.max_age
+
+    def _condition(self, cutoff: datetime):
+        return and_(self.age_column < cutoff, *self.where)
+
+    def count(self, conn, cutoff: datetime) -> int:
+        return conn.execute(select(func.count()).select_from(self.table).where(self._condition(cutoff))).scalar()
+
+    def delete_batch(self, engine, cutoff: datetime, limit: int) -> int:
+        rowid = literal_column("rowid")
+        batch = select(rowid).select_from(self.table) \
+            .where(self._condition(cutoff)) \
+            .order_by(self.age_column) \
+            .limit(limit) \
+            .scalar_subquery()
+        with engine.begin() as conn:
+            return conn.execute(delete(self.table).where(rowid.in_(batch))).rowcount
+
+    # work left over once the table itself is done, for messages the archived blocks
+    def count_extra(self, conn, cutoff: datetime) -> int:
+        return 0
+
+    def delete_extra_batch(self, engine, cutoff: datetime, limit: int) -> int:
+        return 0
+
+class MessagePolicy(Policy):
+    # the newest message is always kept, sqlite hands out max(id) + 1 as the next id,
+    # and a reused id would sort before archived messages that are actually older
+    # that is the newest of the whole table, the newest message of a conversation can go,
+    # its conversation row keeps last_seq (see db.insert_messages) but loses the inbox preview
+    def __init__(self, max_age: timedelta):
+        newest = select(func.max(Message.id)).scalar_subquery()
+        super().__init__("messages", Message.__table__, Message.timestamp, max_age, where=[Message.id < newest])
+
+    def delete_batch(self, engine, cutoff: datetime, limit: int) -> int:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(Message.id, Message.conversation_id)
+                .where(self._condition(cutoff))
+                .order_by(self.age_column)
+                .limit(limit)
+            ).all()
+            if not rows:
+                return 0
+            ids = [row.id for row in rows]
+            deleted = conn.execute(delete(Message).where(Message.id.in_(ids))).rowcount
+            # conversations whose last message was in the batch stop showing its text
+            conn.execute(
+                update(Conversation)
+                .where(Conversation.id.in_({row.conversation_id for row in rows}), Conversation.last_message_id.in_(ids))
+                .values(last_sender=None, last_preview=None, last_timestamp=None)
+            )
+            return deleted
+
+    def count_extra(self, conn, cutoff: datetime) -> int:
+        return archive.count_blocks_before(conn, cutoff)[0]
+
+    # a block is only dropped once its newest message is past the cutoff
+    def delete_extra_batch(self, engine, cutoff: datetime, limit: int) -> int:
+        # blocks hold up to archive.BLOCK_SIZE messages, so this keeps a batch about limit messages
+        messages, _, segments = archive.delete_blocks_before(engine, cutoff, max(1, limit // archive.BLOCK_SIZE))
+        if segments:
+            logger.info("Removed %d archive segments", segments)
+        return messages
+
+def default_policies() -> list:
+    policies = []
+    messages = _days("RETENTION_MESSAGES_DAYS", None)
+    if messages is not None:
+        policies.append(MessagePolicy(messages))
+    friend_requests = _days("RETENTION_FRIEND_REQUESTS_DAYS", 30)
+    if friend_requests is not None:
+        policies.append(Policy("friend_requests", FriendRequest.__table__, FriendRequest.updated_at, friend_requests,
+                               where=[FriendRequest.status == 'accepted']))
+    sessions = _days("RETENTION_SESSIONS_DAYS", 0)
+    if sessions is not None:
+        policies.append(Policy("sessions", SessionRecord.__table__, SessionRecord.expires_at, sessions))
+    return policies
+
+class RetentionSweeper():
+    # get_engine is called on every sweep, so creating a sweeper doesn't open the database
+    # busy returns how many messages the writer has queued, the sweep waits for it to reach 0
+    def __init__(self, get_engine, policies=None, batch: int = BATCH, pause: float = PAUSE,
+                 interval: float = INTERVAL, dry_run: bool = DRY_RUN, busy=None):
+        self.get_engine = get_engine
+        self.policies = default_policies() if policies is None else policies
+        self.batch = batch
+        self.pause = pause
+        self.interval = interval
+        self.dry_run = dry_run
+        self.busy = busy
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        # policy name -> results of the last sweep
+        self.last = {}
+        # policy name -> rows deleted by every sweep of this process
+        self.deleted = {policy.name: 0 for policy in self.policies}
+        # the policy being swept and how far it got
+        self.progress = None
+        self.sweeps = 0
+        self.yielded = 0.0
+        self.last_checkpoint = None
+
+    # runs every policy once, returns policy name -> results
+    # on_progress(name, deleted, total) is called after every batch
+    def sweep(self, now: datetime = None, on_progress=None) -> dict:
+        with self.lock:
+            now = now or datetime.utcnow()
+            engine = self.get_engine()
+            results = {}
+            for policy in self.policies:
+                cutoff = policy.cutoff(now)
+                if self.dry_run:
+                    results[policy.name] = self._count(engine, policy, cutoff)
+                else:
+                    results[policy.name] = self._sweep_policy(engine, policy, cutoff, on_progress)
+            if not self.dry_run and any(result["deleted"] for result in results.values()):
+                self.checkpoint(engine)
+            self.progress = None
+            self.sweeps += 1
+            self.last = results
+            return results
+
+    @staticmethod
+    def _count_rows(engine, policy, cutoff: datetime) -> int:
+        with engine.connect() as conn:
+            return policy.count(conn, cutoff) + policy.count_extra(conn, cutoff)
+
+    def _count(self, engine, policy, cutoff: datetime) -> dict:
+        rows = blocking.run_blocking(self._count_rows, engine, policy, cutoff)
+        return {
+            "cutoff": cutoff.isoformat(),
+            "dry_run": True,
+            "would_delete": rows,
+            "batches": math.ceil(rows / self.batch),
+        }
+
+    def _sweep_policy(self, engine, policy, cutoff: datetime, on_progress) -> dict:
+        total = blocking.run_blocking(self._count_rows, engine, policy, cutoff)
+        started = time.monotonic()
+        deleted = 0
+        batches = 0
+        for delete_batch in (policy.delete_batch, policy.delete_extra_batch):
+            while True:
+                self._yield()
+                count = blocking.run_blocking(delete_batch, engine, cutoff, self.batch)
+                if count == 0:
+                    break
+                deleted += count
+                batches += 1
+                self.deleted[policy.name] += count
+                self.progress = {"policy": policy.name, "deleted": deleted, "total": total}
+                if on_progress is not None:
+                    on_progress(policy.name, deleted, total)
+                if batches % PROGRESS_EVERY == 0:
+                    logger.info("Retention %s: deleted %d of %d", policy.name, deleted, total)
+                if batches % CHECKPOINT_EVERY == 0:
+                    self.checkpoint(engine)
+                time.sleep(self.pause)
+        if deleted:
+            logger.info("Retention %s: deleted %d rows older than %s", policy.name, deleted, cutoff.isoformat())
+        return {
+            "cutoff": cutoff.isoformat(),
+            "deleted": deleted,
+            "batches": batches,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+
+    # waits (up to MAX_YIELD) while the message writer has messages queued,
+    # so the chat never waits behind a retention batch
+    def _yield(self):
+        if self.busy is None:
+            return
+        started = time.monotonic()
+        while self.busy() and time.monotonic() - started < MAX_YIELD:
+            time.sleep(self.pause or 0.01)
+        self.yielded += time.monotonic() - started
+
+    # moves what the WAL holds into the database file, without waiting for (or blocking) anyone
+    # returns (busy, wal frames, frames checkpointed), see sqlite's PRAGMA wal_checkpoint
+    def checkpoint(self, engine):
+        result = blocking.run_blocking(self._checkpoint, engine)
+        self.last_checkpoint = {"at": datetime.utcnow().isoformat(), "result": result}
+        return result
+
+    @staticmethod
+    def _checkpoint(engine):
+        with engine.connect() as conn:
+            return tuple(conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").one())
+
+    # the sweeping thread is started on first use in every process, threads don't survive a fork
+    def start(self):
+        if self.thread_pid == os.getpid() or self.interval <= 0 or not self.policies:
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self._sweep_forever, name="retention-sweeper", daemon=True)
+        self.thread.start()
+
+    def _sweep_forever(self):
+        # spreads the sweeps of several workers out instead of running them all at once
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Retention sweep failed")
+            time.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "policies": {policy.name: policy.max_age.total_seconds() / 86400 for policy in self.policies},
+            "dry_run": self.dry_run,
+            "sweeps": self.sweeps,
+            "deleted": dict(self.deleted),
+            "progress": self.progress,
+            "last_sweep": self.last,
+            "yielded_seconds": round(self.yielded, 3),
+            "last_checkpoint": self.last_checkpoint,
+        }
+
+if __name__ == "__main__":
+    import db
+    sweeper = RetentionSweeper(db.get_engine, dry_run=DRY_RUN or "--dry-run" in sys.argv)
+    if not sweeper.policies:
+        print("every retention policy is off")
+        sys.exit(0)
+    results = sweeper.sweep(on_progress=lambda name, deleted, total: print(f"{name}: {deleted}/{total}", flush=True))
+    for name, result in results.items():
+        print(name, result)
@@ -0,0 +1,85 @@
+'''
+secret_keys
+persistent ring of secret keys used to sign session cookies
+
+the keys live in a file on disk, so a restart or a rolling deploy keeps accepting the
+cookies it handed out before and users don't all have to log in again at once.
+new cookies are signed with the newest key, older keys are only used to verify,
+and once the newest key reaches the rotation age a fresh key is added and the
+oldest one falls off the end of the ring
+
+itsdangerous (used by Flask and Flask-Session) already understands a list of keys,
+signing with the last one and trying all of them when verifying, so the ring is
+handed to Flask as SECRET_KEY in that order
+'''
+
+import fcntl
+import json
+import os
+import secrets
+import time
+from pathlib import Path
+
+# where the ring is stored, keep it out of version control
+KEY_FILE = os.environ.get("SECRET_KEY_FILE", "database/secret_keys.json")
+# how many keys are kept, a cookie stays valid until its key falls off the ring
+MAX_KEYS = int(os.environ.get("SECRET_KEY_RING_SIZE", 3))
+# age after which the newest key is replaced as the signing key
+ROTATE_AFTER = float(os.environ.get("SECRET_KEY_ROTATE_DAYS", 30)) * 24 * 60 * 60
+
+class KeyRing():
+    def __init__(self, path: str = KEY_FILE, max_keys: int = MAX_KEYS, rotate_after: float = ROTATE_AFTER):
+        self.path = Path(path)
+        self.max_keys = max_keys
+        self.rotate_after = rotate_after
+        # oldest first, each entry is {"key": hex string, "created": unix time}
+        self.entries = []
+
+    # loads the ring, creating it (or rotating it when the newest key is too old)
+    # the file is locked while this happens, so workers starting together agree on the keys
+    def load(self) -> "KeyRing":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.entries = self._read()
+            if not self.entries or time.time() - self.entries[-1]["created"] >= self.rotate_after:
+                self._add_key()
+                self._write()
+        return self
+
+    def _read(self) -> list:
+        try:
+            with open(self.path) as key_file:
+                return json.load(key_file)["keys"]
+        except FileNotFoundError:
+            return []
+
+    # written to a temporary file first and renamed, so a crash never leaves half a ring
+    def _write(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as key_file:
+            json.dump({"keys": self.entries}, key_file)
+            key_file.flush()
+            os.fsync(key_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _add_key(self):
+        self.entries.append({"key": secrets.token_hex(32), "created": time.time()})
+        self.entries = self.entries[-self.max_keys:]
+
+    # adds a new signing key now, e.g. after a suspected leak (then lower the ring size as well)
+    def rotate(self):
+        with open(self.path.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.entries = self._read()
+            self._add_key()
+            self._write()
+
+    # oldest to newest, the last one signs
+    def keys(self) -> list:
+        return [entry["key"] for entry in self.entries]
+
+    @property
+    def signing_key(self) -> str:
+        return self.entries[-1]["key"]
@@ -0,0 +1,292 @@
+'''
+session_store
+server side sessions kept in the sqlite database
+
+a session is one row in the sessions table (see models.SessionRecord) instead of one file
+in session_files/, and each worker keeps the most recently used sessions in memory, so a
+request from a logged in user usually doesn't read the database at all
+
+expired rows can be removed in small batches by a background sweep every
+SESSION_SWEEP_INTERVAL seconds. the app turns that off (sweep_interval=0) because
+retention.py already deletes expired sessions along with its other policies
+
+when there are several workers, a worker that changes or deletes a session tells the
+others through the message bus so they drop their cached copy
+
+the old session files can be copied over once with
+    python3 session_store.py import session_files
+'''
+
+import hashlib
+import logging
+import os
+import pickle
+import random
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session.defaults import Defaults
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import db
+import message_bus
+from models import SessionRecord
+
+logger = logging.getLogger(__name__)
+
+# how many sessions each worker keeps in memory
+CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 4096))
+# a cached session is read again from the database after this many seconds,
+# which bounds how stale a copy can get if an invalidation is lost
+CACHE_MAX_AGE = float(os.environ.get("SESSION_CACHE_MAX_AGE", 60))
+# seconds between expiry sweeps, and rows deleted per statement during a sweep
+SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", 300))
+SWEEP_BATCH = int(os.environ.get("SESSION_SWEEP_BATCH", 500))
+# pause between two batches of a sweep, so it never holds the write lock for long
+SWEEP_PAUSE = 0.05
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+# least recently used cache of encoded sessions
+# entries are kept encoded so a request that changes a nested value
+# without saving can't change the cached copy
+class SessionCache():
+    def __init__(self, max_size: int = CACHE_SIZE, max_age: float = CACHE_MAX_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        # record id -> (encoded data, expires_at, time cached)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # returns (data, expires_at), or None when missing, too old or expired
+    def get(self, record_id: str):
+        with self.lock:
+            entry = self.entries.get(record_id)
+            if entry is None or time.monotonic() - entry[2] > self.max_age or entry[1] <= datetime.utcnow():
+                if entry is not None:
+                    del self.entries[record_id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(record_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, record_id: str, data: bytes, expires_at: datetime):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[record_id] = (data, expires_at, time.monotonic())
+            self.entries.move_to_end(record_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, record_id: str):
+        with self.lock:
+            self.entries.pop(record_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    session_class = SQLiteSession
+    # expired rows are removed by our own sweep, not by flask-session's per request cleanup
+    ttl = True
+
+    def __init__(
+        self,
+        app: Flask,
+        engine=None,
+        key_prefix: str = Defaults.SESSION_KEY_PREFIX,
+        use_signer: bool = Defaults.SESSION_USE_SIGNER,
+        permanent: bool = Defaults.SESSION_PERMANENT,
+        sid_length: int = Defaults.SESSION_ID_LENGTH,
+        serialization_format: str = Defaults.SESSION_SERIALIZATION_FORMAT,
+        cache_size: int = CACHE_SIZE,
+        cache_max_age: float = CACHE_MAX_AGE,
+        sweep_interval: float = SWEEP_INTERVAL,
+        sweep_batch: int = SWEEP_BATCH,
+    ):
+        # None means the app's engine, looked up on first use so creating the interface
+        # doesn't open the database
+        self._engine = engine
+        self.cache = SessionCache(cache_size, cache_max_age)
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.sweeper = None
+        self.sweeper_pid = None
+        self.swept = 0
+        super().__init__(app, key_prefix, use_signer, permanent, sid_length, serialization_format)
+
+        # threads don't survive a fork, so each worker starts its sweep on its first request
+        app.before_request(self.start_sweeper)
+        message_bus.on_invalidate("session", self._forget)
+        # a worker that wasn't listening yet may have missed some of those
+        message_bus.on_resync(self.cache.clear)
+
+    @property
+    def engine(self):
+        return self._engine if self._engine is not None else db.get_engine()
+
+    # rows are keyed by the md5 of the store id, the same name the old session files had
+    @staticmethod
+    def _record_id(store_id: str) -> str:
+        return hashlib.md5(store_id.encode("utf-8")).hexdigest()
+
+    def _forget(self, record_id: str):
+        self.cache.pop(record_id)
+
+    def _retrieve_session_data(self, store_id: str):
+        record_id = self._record_id(store_id)
+        cached = self.cache.get(record_id)
+        if cached is None:
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    select(SessionRecord.data, SessionRecord.expires_at)
+                    .where(SessionRecord.id == record_id, SessionRecord.expires_at > datetime.utcnow())
+                ).first()
+            if row is None:
+                return None
+            cached = (row.data, row.expires_at)
+            self.cache.put(record_id, *cached)
+        return self.serializer.decode(cached[0])
+
+    def _upsert_session(self, session_lifetime: timedelta, session: ServerSideSession, store_id: str):
+        record_id = self._record_id(store_id)
+        data = self.serializer.encode(session)
+        expires_at = datetime.utcnow() + session_lifetime
+        statement = sqlite_insert(SessionRecord).values(id=record_id, data=data, expires_at=expires_at)
+        statement = statement.on_conflict_do_update(
+            index_elements=[SessionRecord.id],
+            set_={"data": statement.excluded.data, "expires_at": statement.excluded.expires_at},
+        )
+        with self.engine.begin() as conn:
+            conn.execute(statement)
+        self.cache.put(record_id, data, expires_at)
+        message_bus.publish_invalidation("session", record_id=record_id)
+
+    def _delete_session(self, store_id: str):
+        record_id = self._record_id(store_id)
+        with self.engine.begin() as conn:
+            conn.execute(delete(SessionRecord).where(SessionRecord.id == record_id))
+        self.cache.pop(record_id)
+        message_bus.publish_invalidation("session", record_id=record_id)
+
+    # an unchanged session is only written again once half of its lifetime has passed,
+    # instead of on every request as SESSION_REFRESH_EACH_REQUEST would do
+    def should_set_storage(self, app: Flask, session: ServerSideSession) -> bool:
+        if session.modified:
+            return True
+        if not app.config["SESSION_REFRESH_EACH_REQUEST"]:
+            return False
+        cached = self.cache.get(self._record_id(self._get_store_id(session.sid)))
+        if cached is None:
+            return True
+        return cached[1] - datetime.utcnow() < app.permanent_session_lifetime / 2
+
+    # deletes expired sessions in batches of sweep_batch rows, returns how many were deleted
+    # each batch is its own short transaction so chat writes can get in between them
+    def _delete_expired_sessions(self) -> int:
+        deleted = 0
+        while True:
+            now = datetime.utcnow()
+            expired = (
+                select(SessionRecord.id)
+                .where(SessionRecord.expires_at <= now)
+                .limit(self.sweep_batch)
+                .scalar_subquery()
+            )
+            with self.engine.begin() as conn:
+                count = conn.execute(delete(SessionRecord).where(SessionRecord.id.in_(expired))).rowcount
+            deleted += count
+            if count < self.sweep_batch:
+                break
+            time.sleep(SWEEP_PAUSE)
+        self.swept += deleted
+        return deleted
+
+    def start_sweeper(self):
+        if self.sweeper_pid == os.getpid() or self.sweep_interval <= 0:
+            return
+        self.sweeper_pid = os.getpid()
+        self.sweeper = threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True)
+        self.sweeper.start()
+
+    def _sweep_forever(self):
+        # spreads the sweeps of several workers out instead of running them all at once
+        time.sleep(random.uniform(0, self.sweep_interval))
+        while True:
+            try:
+                deleted = self._delete_expired_sessions()
+                if deleted:
+                    logger.info("Deleted %d expired sessions", deleted)
+            except Exception:
+                logger.exception("Session sweep failed")
+            time.sleep(self.sweep_interval)
+
+    def stats(self) -> dict:
+        return {"cache": self.cache.stats(), "swept": self.swept}
+
+    # copies sessions saved by the filesystem backend into the table
+    # a session file is a 4 byte expiry (0 means never) followed by the pickled session,
+    # and its name is already the md5 of the store id
+    # expired sessions are skipped unless include_expired is set, then they get a fresh lifetime
+    # returns (imported, skipped)
+    def import_files(self, directory: str, include_expired: bool = False):
+        now = time.time()
+        lifetime = self.app.permanent_session_lifetime
+        rows = []
+        skipped = 0
+        for path in Path(directory).iterdir():
+            if len(path.name) != 32 or not path.is_file():
+                skipped += 1
+                continue
+            try:
+                raw = path.read_bytes()
+                expires = struct.unpack("I", raw[:4])[0]
+                value = pickle.loads(raw[4:])
+            except Exception:
+                skipped += 1
+                continue
+            # the cache also keeps an entry counter in a file named like a session
+            if not isinstance(value, (bytes, dict)):
+                skipped += 1
+                continue
+            if expires != 0 and expires < now and not include_expired:
+                skipped += 1
+                continue
+            if expires == 0 or expires < now:
+                expires_at = datetime.utcnow() + lifetime
+            else:
+                expires_at = datetime.utcfromtimestamp(expires)
+            data = value if isinstance(value, bytes) else self.serializer.encode(value)
+            rows.append({"id": path.name, "data": data, "expires_at": expires_at})
+
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(sqlite_insert(SessionRecord).on_conflict_do_nothing(), rows)
+        return len(rows), skipped
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("usage: python3 session_store.py import [directory] [--include-expired]")
+        sys.exit(1)
+    directory = next((arg for arg in sys.argv[2:] if not arg.startswith("--")), "session_files")
+    app = Flask(__name__)
+    interface = SQLiteSessionInterface(app, sweep_interval=0)
+    imported, skipped = interface.import_files(directory, include_expired="--include-expired" in sys.argv)
+    print(f"imported {imported} sessions, skipped {skipped}")
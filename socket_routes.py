@@ -5,98 +5,218 @@ file containing all the routes related to socket.io
 
 # from Crypto.PublicKey import DH
 # from Crypto.Random import get_random_bytes
-from flask_socketio import join_room, emit, leave_room
-from flask import request
+from flask_socketio import SocketIO, join_room, emit, leave_room
+from flask import request, session
+import uuid
 
-try:
-    from __main__ import socketio
-except ImportError:
-    from app import socketio
-
-from models import Room
+from models import RoomRegistry, conversation_id
+from message_writer import writer
+from connections import ConnectionRegistry
+from backpressure import limiter
 
 import db
 
-room = Room()
+# the handlers below are attached to it here, and it is bound to the app
+# (async mode, message queue) by create_app() in app.py
+socketio = SocketIO()
+
+room = RoomRegistry()
+# who is behind each socket, see connections.py
+connections = ConnectionRegistry()
+
+# the context of the socket that sent the current event,
+# None when the socket never authenticated
+def current_context():
+    return connections.get(request.sid)
+
+# every socket of a user is also in that user's own room, so one emit reaches
+# all of the user's tabs, on whichever worker they are connected
+def user_room(username):
+    return f"user:{username}"
+
+# pushes one change of a user's friend or pending request list as a "friend_update" event,
+# kind is request_received, request_removed, friend_added or friend_removed
+# and username is the other user of the request or friendship
+def push_friend_update(username, kind, other_username):
+    socketio.emit("friend_update", {"type": kind, "username": other_username}, to=user_room(username))
+
+# puts the socket into the conversation room with receiver and returns the room id
+def enter_room(context, receiver_name):
+    room_id = room.create_room(context.username, receiver_name, request.sid)
+    join_room(room_id)
+    context.rooms[room_id] = receiver_name
+    return room_id
+
+# explicit invalidation of the friend snapshots, called whenever a friendship is added
+# or removed in this process or in another worker
+# sockets of users who are no longer friends are taken out of their conversation room
+def friendship_changed(action, username, friend_username):
+    for context, room_id in connections.friendship_changed(action, username, friend_username):
+        socketio.server.leave_room(context.sid, room_id, namespace="/")
+        room.leave_room(context.username, room_id)
 
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
+# the user is taken from the login session once, the rest of the connection uses the context
 @socketio.on('connect')
 def connect():
-    username = request.cookies.get("username")
+    username = session.get("username")
+    if username is None:
+        # not logged in, refuse the connection
+        return False
+    context = connections.open(request.sid, username, db.get_friend_graph().friends_of(username))
+    join_room(user_room(username))
+
     room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    receiver = request.cookies.get("receiver")
+    if room_id is None or receiver is None or not room_id.isdigit():
         return
     # socket automatically leaves a room on client disconnect
     # so on client connect, the room needs to be rejoined
-    join_room(int(room_id))
-    emit("incoming", (f"{username} has connected", "green"), to=int(room_id))
+    # the room id is derived from the two usernames, so the registry entry can be
+    # rebuilt here without a lookup, whichever process this socket landed on
+    if not context.is_friend(receiver) or conversation_id(username, receiver) != int(room_id):
+        return
+    room_id = enter_room(context, receiver)
+    emit("incoming", (f"{username} has connected", "green"), to=room_id)
 
 # event when client disconnects
 # quite unreliable use sparingly
 @socketio.on('disconnect')
 def disconnect():
-    username = request.cookies.get("username")
-    room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    # forget the socket, otherwise the registry would only ever grow
+    room.disconnect(request.sid)
+    context = connections.close(request.sid)
+    if context is None:
         return
-    emit("incoming", (f"{username} has disconnected", "red"), to=int(room_id))
+    for room_id, peer in context.rooms.items():
+        emit("incoming", (f"{context.username} has disconnected", "red"), to=room_id)
+        db.mark_read(context.username, peer)
+
+# longest idempotency key accepted from a client
+MAX_CLIENT_KEY_LENGTH = 64
 
 # send message event handler
+# the username argument is ignored, the sender is the user behind the socket
+# client_key identifies the message, a client that resends it after a network blip
+# (socket.io resends buffered events on reconnect) with the same key doesn't create a second
+# row, and clients drop incoming messages whose key they have already shown
 @socketio.on("send")
-def send(username, message, room_id):
-    emit("incoming", (f"{username}: {message}"), to=room_id)
+def send(username, message, room_id, client_key=None):
+    context = current_context()
+    if context is None or room_id not in context.rooms:
+        return "You are not in this room!"
+    if not limiter.allow(context.username, "send"):
+        return "You are sending messages too fast!"
+    if not isinstance(client_key, str) or not 0 < len(client_key) <= MAX_CLIENT_KEY_LENGTH:
+        client_key = uuid.uuid4().hex
+    emit("incoming", (f"{context.username}: {message}", "white", client_key), to=room_id)
     # 存储消息到数据库
-    receiver = room.get_receiver_in_room(username, room_id)
-    if receiver:
-        db.insert_message(username, receiver, message)
+    # the message is written by the background writer, so the handler never waits on a commit
+    writer.enqueue(context.username, context.rooms[room_id], message, client_key)
+
+# a message only gets its seq when the writer commits it, after the "incoming" event has gone out,
+# so the seqs follow as one "seq" event per conversation room with [client_key, seq] pairs
+# clients move last_seq forward with them and a reconnect syncs only what was really missed
+def messages_written(stored):
+    rooms = {}
+    for room_id, client_key, seq in stored or ():
+        rooms.setdefault(room_id, []).append([client_key, seq])
+    for room_id, pairs in rooms.items():
+        socketio.emit("seq", pairs, to=room_id)
+
+writer.subscribe(messages_written)
     
 # join room event handler
 # sent when the user joins a room
+# the sender is the user behind the socket, and the friendship check uses the
+# connection's friend snapshot, so joining needs no database access
 @socketio.on("join")
 def join(sender_name, receiver_name):
-    receiver = db.get_user(receiver_name)
-    if receiver is None:
-        return "Unknown receiver!"
-    
-    sender = db.get_user(sender_name)
-    if sender is None:
+    context = current_context()
+    if context is None:
         return "Unknown sender!"
-    
+    sender_name = context.username
+    if not limiter.allow(sender_name, "join"):
+        return "You are switching rooms too fast!"
+
     # Check if sender and receiver are friends
-    are_friends = db.check_friends(sender_name, receiver_name)
-    if not are_friends:
+    if not context.is_friend(receiver_name):
+        # only the error path asks the database which message applies
+        if not db.check_user_exists(receiver_name):
+            return "Unknown receiver!"
         return "You are not friends with this user. Please send a friend"
-
-    room_id = room.get_room_id(receiver_name)
+    # the history sent below covers everything unread in this conversation
+    db.mark_read(sender_name, receiver_name)
 
     # if the user is already inside of a room 
-    if room_id is not None:
-        room.join_room(sender_name, room_id)
-        join_room(room_id)
+    if room.get_room_id(sender_name, receiver_name) is not None:
+        room_id = enter_room(context, receiver_name)
         # emit to everyone in the room except the sender
         emit("incoming", (f"{sender_name} has joined the room.", "green"), to=room_id, include_self=False)
         # emit only to the sender
         emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"))
+        emit("history", history_page(sender_name, receiver_name))
         return room_id
 
     # if the user isn't inside of any room, 
     # perhaps this user has recently left a room
     # or is simply a new user looking to chat with someone
-    room_id = room.create_room(sender_name, receiver_name)
-    join_room(room_id)
+    room_id = enter_room(context, receiver_name)
     emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"), to=room_id)
     
     # 加载消息历史记录
-    messages = db.get_messages(sender_name)
-    for msg in messages:
-        emit("incoming", (f"{msg[0]}: {msg[1]}", "black"))
+    # the latest page goes out as a single frame, older pages are requested with "load_older"
+    emit("history", history_page(sender_name, receiver_name))
         
     return room_id
 
+# number of messages sent per history page
+HISTORY_PAGE_SIZE = 50
+
+# one page of the conversation, newest message first
+# has_more tells the client whether a "load_older" request can return anything
+def history_page(sender_name, receiver_name, before_id=None):
+    messages = db.get_conversation_page(sender_name, receiver_name, before_id=before_id, limit=HISTORY_PAGE_SIZE)
+    return {"messages": messages, "has_more": len(messages) == HISTORY_PAGE_SIZE}
+
+# load older messages event handler
+# sent when the user scrolls back past the history they already have,
+# the page is returned through the ack callback instead of a separate event
+@socketio.on("load_older")
+def load_older(sender_name, receiver_name, before_id):
+    if not isinstance(before_id, int):
+        return "Invalid message id!"
+    context = current_context()
+    if context is None or not context.is_friend(receiver_name):
+        return "You are not friends with this user. Please send a friend"
+    return history_page(context.username, receiver_name, before_id)
+
+# sync event handler
+# sent by the client after every (re)connect, with the seq of the newest message it has
+# only the messages after that one are returned through the ack, so reconnecting costs
+# as much as what was missed. without a seq the client gets the latest history page
+@socketio.on("sync")
+def sync(receiver_name, since_seq=None):
+    context = current_context()
+    if context is None or not context.is_friend(receiver_name):
+        return "You are not friends with this user. Please send a friend"
+    db.mark_read(context.username, receiver_name)
+    if since_seq is None:
+        return history_page(context.username, receiver_name)
+    if not isinstance(since_seq, int):
+        return "Invalid sequence number!"
+    return db.get_conversation_since(context.username, receiver_name, since_seq)
+
 # leave room event handler
 @socketio.on("leave")
 def leave(username, room_id):
-    emit("incoming", (f"{username} has left the room.", "red"), to=room_id)
+    context = current_context()
+    if context is None or room_id not in context.rooms:
+        return
+    emit("incoming", (f"{context.username} has left the room.", "red"), to=room_id)
+    # whatever arrived while the room was open has been seen
+    db.mark_read(context.username, context.rooms[room_id])
     leave_room(room_id)
-    room.leave_room(username)
+    room.leave_room(context.username, room_id)
+    del context.rooms[room_id]
@@ -0,0 +1,93 @@
+'''
+the db write helpers are single set-based statements, these count the statements
+each one sends to sqlite, one on success and a second only to work out a failure reason
+'''
+
+import pytest
+from sqlalchemy import event
+
+import db
+
+@pytest.fixture
+def statements(monkeypatch):
+    # a fresh in-memory database for every test
+    monkeypatch.setenv("DB_PROFILE", "memory")
+    monkeypatch.setattr(db, "_engine", None)
+    db.friend_graph.invalidate()
+    engine = db.get_engine()
+    for username in ("alice", "bob", "carol"):
+        db.insert_user(username, "hash")
+    # the friend graph is loaded once per process, not by the helpers
+    db.get_friend_graph()
+
+    executed = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(engine, "before_cursor_execute", count)
+    db.friend_graph.invalidate()
+    engine.dispose()
+
+def test_insert_user(statements):
+    assert db.insert_user("dave", "hash")
+    assert not db.insert_user("dave", "hash")
+    assert len(statements) == 2
+
+def test_add_friend_request(statements):
+    assert db.add_friend_request("alice", "bob") == (True, None)
+    assert len(statements) == 1
+
+    del statements[:]
+    assert db.add_friend_request("alice", "bob") == (False, "Friend request already sent")
+    assert len(statements) == 2
+
+    del statements[:]
+    assert db.add_friend_request("alice", "nobody") == (False, "One or both users do not exist")
+    assert len(statements) == 2
+
+def test_accept_friend_request(statements):
+    db.add_friend_request("alice", "bob")
+    del statements[:]
+    assert db.accept_friend_request("alice", "bob") is True
+    # the UPDATE of the request and the INSERT of both friendship rows
+    assert len(statements) == 2
+    assert db.check_friends("alice", "bob")
+
+    del statements[:]
+    assert db.accept_friend_request("alice", "bob") == (False, "Request not found")
+    assert len(statements) == 1
+
+def test_decline_friend_request(statements):
+    db.add_friend_request("alice", "bob")
+    del statements[:]
+    assert db.decline_friend_request("alice", "bob") is True
+    assert len(statements) == 1
+
+    del statements[:]
+    assert db.decline_friend_request("alice", "bob") == (False, "Request not found")
+    assert len(statements) == 1
+
+def test_remove_friend(statements):
+    db.add_friend_request("alice", "bob")
+    db.accept_friend_request("alice", "bob")
+    del statements[:]
+    assert db.remove_friend("alice", "bob") == (True, None)
+    assert len(statements) == 1
+    assert not db.check_friends("alice", "bob")
+
+    del statements[:]
+    assert db.remove_friend("alice", "bob") == (False, "User is not in the friend list")
+    assert len(statements) == 2
+
+def test_add_friend_request_after_remove_friend(statements):
+    db.add_friend_request("alice", "bob")
+    db.accept_friend_request("alice", "bob")
+    db.remove_friend("alice", "bob")
+    del statements[:]
+    # the accepted request left behind is sent again, still as one statement
+    assert db.add_friend_request("alice", "bob") == (True, None)
+    assert len(statements) == 1
+    assert db.get_pending_friend_requests("bob") == [("alice", "bob")]
+    assert db.accept_friend_request("alice", "bob") is True
+    assert db.check_friends("alice", "bob")
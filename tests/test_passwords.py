@@ -0,0 +1,50 @@
+'''
+smoke check that a password can be hashed and checked in every async mode
+each mode runs in a fresh interpreter, blocking.py monkey patches the standard library
+on import and a hang shows up as a timeout
+'''
+
+import importlib.util
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SCRIPT = """
+import blocking
+import passwords
+
+hasher = passwords.PasswordHasher(pool_size=1, rounds=4)
+if blocking.ASYNC_MODE == "eventlet":
+    import eventlet
+    spawn, wait = eventlet.spawn, lambda thread: thread.wait()
+elif blocking.ASYNC_MODE == "gevent":
+    import gevent
+    spawn, wait = gevent.spawn, lambda thread: thread.get()
+else:
+    spawn, wait = (lambda fn, *args: fn(*args)), (lambda result: result)
+
+hashes = [wait(thread) for thread in [spawn(hasher.hash, "pw") for _ in range(3)]]
+assert wait(spawn(hasher.check, "pw", hashes[0]))
+assert not wait(spawn(hasher.check, "wrong", hashes[0]))
+print("ok")
+"""
+
+@pytest.mark.parametrize("mode", ["threading", "eventlet", "gevent"])
+def test_hash_in_async_mode(mode):
+    if mode != "threading" and importlib.util.find_spec(mode) is None:
+        pytest.skip(f"{mode} is not installed")
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        cwd=ROOT,
+        env={**os.environ, "ASYNC_MODE": mode},
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith("ok")
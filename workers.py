@@ -0,0 +1,180 @@
+'''
+workers
+runs the server as several worker processes sharing one listening socket
+
+the parent binds the socket and forks the workers, the kernel then hands each new
+connection to whichever worker accepts it first. the workers don't share any memory,
+so socket.io emits and cache invalidations between them go through message_bus.
+
+because a client's requests can land on any worker, the long-polling transport
+(which needs every request of a session to reach the same process) is turned off
+in this mode and clients connect with websockets only
+
+every worker runs the server that matches the async mode (see blocking.py),
+the werkzeug server for threading, eventlet.wsgi or gevent's pywsgi otherwise
+'''
+
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+# how long to wait before restarting a worker that crashed, so a broken worker can't spin
+RESTART_DELAY = 1.0
+
+def bind_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+# every websocket is an open file, so the soft limit (often 1024) is raised to the hard limit
+def raise_open_file_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+# extra arguments for socketio.run / the green servers
+# max_connections caps the number of connections a worker serves at once,
+# further clients wait in the listen backlog instead of exhausting memory
+def server_options(async_mode: str, ssl_context=None, max_connections: int = None) -> dict:
+    options = {}
+    if async_mode == "threading":
+        if ssl_context is not None:
+            options["ssl_context"] = ssl_context
+        return options
+    if ssl_context is not None:
+        options["certfile"], options["keyfile"] = ssl_context
+    if max_connections:
+        if async_mode == "eventlet":
+            options["max_size"] = max_connections
+        else:
+            from gevent.pool import Pool
+            options["spawn"] = Pool(max_connections)
+    return options
+
+# the body of one worker process, runs until the process is told to stop
+def run_worker(app, sock: socket.socket, ssl_context=None, async_mode: str = "threading",
+               max_connections: int = None):
+    options = server_options(async_mode, ssl_context, max_connections)
+    if async_mode == "eventlet":
+        import eventlet
+        import eventlet.wsgi
+        listener = sock
+        if ssl_context is not None:
+            listener = eventlet.wrap_ssl(sock, certfile=options.pop("certfile"),
+                                         keyfile=options.pop("keyfile"), server_side=True)
+        eventlet.wsgi.server(listener, app, log_output=False, **options)
+    elif async_mode == "gevent":
+        import gevent
+        from gevent import pywsgi
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+            options["handler_class"] = WebSocketHandler
+        except ImportError:
+            pass
+        server = pywsgi.WSGIServer(sock, app, log=None, **options)
+        # an exception raised by a signal handler would land in gevent's hub,
+        # so the server is stopped from gevent's own signal handling instead
+        gevent.signal_handler(signal.SIGINT, server.stop)
+        gevent.signal_handler(signal.SIGTERM, server.stop)
+        server.serve_forever()
+    else:
+        server = make_server(sock.getsockname()[0], sock.getsockname()[1], app,
+                             threaded=True, ssl_context=ssl_context, fd=sock.fileno())
+        server.serve_forever()
+
+# SIGTERM stops a worker the same way ctrl-c does, the servers return from their
+# accept loop on KeyboardInterrupt (gevent's is stopped in run_worker), so the
+# worker gets to run before_exit
+def _interrupt(signum, _frame):
+    raise KeyboardInterrupt
+
+# forks `workers` processes serving app on host:port and supervises them
+# after_fork runs in every worker before it starts serving, this is where
+# state inherited from the parent (database connections etc.) gets reset
+# before_exit runs in every worker once it has stopped serving, the worker leaves
+# through os._exit which skips atexit, so whatever must be written out goes here
+def serve(app, host: str, port: int, workers: int, ssl_context=None, after_fork=None,
+          before_exit=None, async_mode: str = "threading", max_connections: int = None):
+    if async_mode != "threading":
+        raise_open_file_limit()
+    sock = bind_socket(host, port)
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, _interrupt)
+            signal.signal(signal.SIGTERM, _interrupt)
+            exit_code = 0
+            try:
+                if after_fork is not None:
+                    after_fork()
+                run_worker(app, sock, ssl_context, async_mode, max_connections)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                if before_exit is not None:
+                    # a second SIGTERM must not cut this short
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                    try:
+                        before_exit()
+                    except BaseException:
+                        import traceback
+                        traceback.print_exc()
+                        exit_code = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        children[pid] = index
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    scheme = "https" if ssl_context else "http"
+    print(f" * Running {workers} {async_mode} workers on {scheme}://{host}:{port}")
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f" * Worker {index} (pid {pid}) exited with status {status}, restarting")
+        time.sleep(RESTART_DELAY)
+        spawn(index)
+    sock.close()